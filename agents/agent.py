@@ -5,7 +5,12 @@ The simplest possible implementation of an agent loop.
 No abstractions. No bells and whistles. Just the core loop.
 """
 
+import asyncio
+import contextvars
+import functools
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from agents.tools import TOOLS, TOOL_FUNCTIONS, current_user_id
 import litellm
@@ -14,16 +19,53 @@ import warnings
 warnings.filterwarnings("ignore", category=UserWarning, module="pydantic")
 load_dotenv()
 
+# Bounded pool for blocking tool calls (sandbox exec). Caps how many tools run at
+# once across all users, so a burst of tool calls can't swamp the sandbox service.
+TOOL_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tool")
+# Max tool calls from a single LLM turn run at once (0 = all of them). Defaults to 1:
+# run_code calls share the user's one sandbox interpreter, so a call can depend on an
+# earlier one (define x, then use x) and must run after it. ModalSandbox.run_code also
+# serializes calls itself, so a higher limit can't interleave runs, but loses the order.
+TOOL_CONCURRENCY_LIMIT = int(os.getenv("TOOL_CONCURRENCY_LIMIT", "1"))
 
-def run_agent(messages, user_id: str):
+
+@functools.lru_cache(maxsize=256)
+def _parse_args(arguments: str) -> dict:
+    """Parse tool call arguments (cached: retried calls repeat the same JSON).
+
+    The cached dict is shared, so callers only unpack it with ** and never mutate it.
+    """
+    return json.loads(arguments)
+
+
+def _call_tool(name: str, arguments: str):
+    """Run one tool call. Errors become the tool's content so one bad call can't sink the turn."""
+    try:
+        return TOOL_FUNCTIONS[name](**_parse_args(arguments))
+    except Exception as e:
+        return f"Error: {type(e).__name__}: {e}"
+
+
+async def _run_tool(tool_call, limit: asyncio.Semaphore):
+    """Run a tool call on the tool pool.
+
+    Tools make blocking sandbox calls, so they run in a worker thread. run_in_executor
+    doesn't copy the context, so the call carries current_user_id over explicitly.
+    """
+    async with limit:
+        call = functools.partial(contextvars.copy_context().run, _call_tool, tool_call.function.name, tool_call.function.arguments)
+        return await asyncio.get_running_loop().run_in_executor(TOOL_EXECUTOR, call)
+
+
+async def run_agent(messages, user_id: str):
     """
-    The agent loop as a generator - yields messages as they're added.
+    The agent loop as an async generator - yields messages as they're added.
 
     Args:
         messages: List of chat messages
         user_id: The user ID for sandbox isolation
 
-    Yields messages in standard Chat Completions format:
+    Yields plain dicts in standard Chat Completions format:
       - {"role": "assistant", "tool_calls": [...], ...}  # Assistant requesting tool calls
       - {"role": "tool", "tool_call_id": ..., "content": ...}  # Tool result
       - {"role": "assistant", "content": ...}  # Final response (no tool_calls)
@@ -39,8 +81,8 @@ def run_agent(messages, user_id: str):
     total_tokens = 0
 
     while True:
-        # Call the LLM
-        response = litellm.completion(
+        # Call the LLM (awaited, so other streams keep running while we wait)
+        response = await litellm.acompletion(
             model="claude-opus-4-5-20251101",  # "gemini/gemini-3-flash-preview", #claude-opus-4-5-20251101, gpt-5.2
             messages=messages,
             tools=TOOLS,
@@ -62,33 +104,51 @@ def run_agent(messages, user_id: str):
             yield final_msg
             return
 
-        # Assistant message with tool calls - add and yield it
+        # Assistant message with tool calls - keep the original in history (it carries
+        # provider extras like thinking blocks) and yield a plain dict copy for the UI
         messages.append(message)
-        yield message
-
-        # Execute each tool and yield results
-        for tool_call in message.tool_calls:
-            name = tool_call.function.name
-            args = json.loads(tool_call.function.arguments)
-            result = TOOL_FUNCTIONS[name](**args)
-
-            # Full result for UI (includes plotly_html for rendering)
-            tool_msg = {
-                "role": "tool",
-                "tool_call_id": tool_call.id,
-                "content": result,
-            }
-            yield tool_msg
-
-            # Filtered result for LLM (only valid content types)
-            # If result is a list of content blocks, filter out non-LLM types like plotly_html
-            if isinstance(result, list):
-                llm_content = [c for c in result if c.get("type") in ("text", "image_url")]
-            else:
-                llm_content = result  # String or other format, pass through
-            llm_tool_msg = {
-                "role": "tool",
-                "tool_call_id": tool_call.id,
-                "content": llm_content,
-            }
-            messages.append(llm_tool_msg)
+        yield {
+            "role": "assistant",
+            "content": message.content,
+            "tool_calls": [
+                {
+                    "id": tc.id,
+                    "type": "function",
+                    "function": {"name": tc.function.name, "arguments": tc.function.arguments},
+                }
+                for tc in message.tool_calls
+            ],
+        }
+
+        # Run the tool calls on the tool pool, yielding results in call order as they finish
+        # (TOOL_CONCURRENCY_LIMIT caps how many run at once; the tool pool also caps it overall)
+        limit = asyncio.Semaphore(TOOL_CONCURRENCY_LIMIT or len(message.tool_calls))
+        tasks = [asyncio.ensure_future(_run_tool(tc, limit)) for tc in message.tool_calls]
+        try:
+            for tool_call, task in zip(message.tool_calls, tasks):
+                result = await task
+
+                # Full result for UI (includes plotly_html for rendering)
+                tool_msg = {
+                    "role": "tool",
+                    "tool_call_id": tool_call.id,
+                    "content": result,
+                }
+                yield tool_msg
+
+                # Filtered result for LLM (only valid content types)
+                # If result is a list of content blocks, filter out non-LLM types like plotly_html
+                if isinstance(result, list):
+                    llm_content = [c for c in result if c.get("type") in ("text", "image_url")]
+                else:
+                    llm_content = result  # String or other format, pass through
+                llm_tool_msg = {
+                    "role": "tool",
+                    "tool_call_id": tool_call.id,
+                    "content": llm_content,
+                }
+                messages.append(llm_tool_msg)
+        finally:
+            # Stream closed early - don't leave tool calls running for nobody
+            for task in tasks:
+                task.cancel()
@@ -1,5 +1,8 @@
+import functools
 import json
 import os
+import random
+import threading
 import time
 from contextlib import contextmanager
 from typing import Any, Dict, Generator, Literal, Optional
@@ -22,6 +25,8 @@ DEFAULT_RETRY_DELAY = 0.1
 # This translates to the max time we'll wait for the output file to be created.
 MAXIMUM_CODE_RUNTIME = 300
 MAXIMUM_OPEN_FILE_ATTEMPTS = int(MAXIMUM_CODE_RUNTIME / DEFAULT_RETRY_DELAY)
+# Cap on the backoff delay after repeated FilesystemExecutionErrors (in seconds)
+MAXIMUM_RETRY_DELAY = 2.0
 
 IO_DATA_DIR = "/modal/io"
 STDIN_FILE = os.path.join(IO_DATA_DIR, "stdin.txt")
@@ -36,6 +41,12 @@ SANDBOX_CPU = 4.0
 SANDBOX_MEMORY = 4096
 
 
+@functools.lru_cache(maxsize=4)
+def _get_app(name: str) -> modal.App:
+    # App.lookup is a network call and the app never changes, so look it up once per process
+    return modal.App.lookup(name, create_if_missing=True)
+
+
 class ModalSandbox:
     IMAGE = (
         modal.Image.debian_slim()
@@ -79,6 +90,9 @@ class ModalSandbox:
         init_script: Optional[str] = None,
         **kwargs: Any,
     ) -> None:
+        # One run_code at a time: calls share the interpreter state and the STDIN/output
+        # file exchange, so concurrent calls could run out of order or interleave
+        self._run_lock = threading.Lock()
         # check if running Sandbox already exists
         if sandbox_id is not None:
             existing_sb = self._get_running_sandbox_from_id(sandbox_id)
@@ -86,7 +100,7 @@ class ModalSandbox:
                 self.sandbox = existing_sb
                 return
 
-        app = modal.App.lookup("python-sandbox", create_if_missing=True)
+        app = _get_app("python-sandbox")
         driver_program = get_script_as_string("agents/driver_program.py")
         # Use provided values or fall back to defaults
         timeout = kwargs.pop("timeout", SANDBOX_TIMEOUT)
@@ -144,12 +158,17 @@ class ModalSandbox:
         Occasionally, attempting to open a file within the Modal sandbox results in an unexpected
         FilesystemExecutionError (related to concurrent access). This context manager
         provides retry logic so we can consistently open the file.
+
+        FilesystemExecutionErrors back off exponentially with jitter, so concurrent callers
+        don't retry in lockstep. Extra exceptions (e.g. FileNotFoundError while polling for
+        output) retry every `retry_delay`, keeping the attempts-to-runtime math intact.
         """
 
         extra_exceptions = extra_exceptions or ()
         retry_on_exceptions: tuple[type[Exception], ...] = (modal.exception.FilesystemExecutionError,) + extra_exceptions
 
         attempt = 0
+        fs_errors = 0
         while True:
             try:
                 with self.sandbox.open(file_path, mode) as f:
@@ -160,9 +179,18 @@ class ModalSandbox:
                 if attempt >= max_attempts:
                     raise e
 
-                time.sleep(retry_delay)
+                if isinstance(e, modal.exception.FilesystemExecutionError):
+                    delay = min(MAXIMUM_RETRY_DELAY, retry_delay * 2**fs_errors)
+                    fs_errors += 1
+                    time.sleep(delay + random.uniform(0, retry_delay / 2))
+                else:
+                    time.sleep(retry_delay)
 
     def run_code(self, code: str) -> Dict[str, str]:
+        with self._run_lock:
+            return self._run_code(code)
+
+    def _run_code(self, code: str) -> Dict[str, str]:
         command_id = uuid4().hex
 
         # 1. Write code into a STDIN file on the sandbox.
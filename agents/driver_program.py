@@ -1,4 +1,5 @@
 import base64
+import functools
 import json
 import os
 import sys
@@ -40,6 +41,14 @@ def tail_f(filename: str) -> Generator[str, None, None]:
             yield line
 
 
+@functools.lru_cache(maxsize=64)
+def compile_code(code: str):
+    """
+    Compile a code string once; repeated commands (e.g. the same init script) reuse the code object.
+    """
+    return compile(code, "<sandbox>", "exec")
+
+
 # Track captured objects by id() to avoid duplicate captures across code executions
 _captured_ids: set[int] = set()
 
@@ -62,7 +71,7 @@ for line in tail_f(STDIN_FILE):
     stdout_io, stderr_io = StringIO(), StringIO()
     with redirect_stdout(stdout_io), redirect_stderr(stderr_io):
         try:
-            exec(code, globals)
+            exec(compile_code(code), globals)
         except Exception as e:
             print(f"{type(e).__name__}: {e}", file=sys.stderr)
 
@@ -75,9 +84,8 @@ for line in tail_f(STDIN_FILE):
             fig = plt.figure(fig_num)
             buf = BytesIO()
             fig.savefig(buf, format="png", bbox_inches="tight", dpi=150)
-            buf.seek(0)
-            images.append(base64.b64encode(buf.read()).decode("utf-8"))
-            buf.close()
+            # Encode straight from the buffer's memory instead of copying it out first
+            images.append(base64.b64encode(buf.getbuffer()).decode("utf-8"))
         plt.close("all")  # Clean up figures after capturing
     except ImportError:
         pass  # matplotlib not available
@@ -122,8 +130,7 @@ for line in tail_f(STDIN_FILE):
                 if buf.tell() <= max_size_bytes:
                     if quality < 85:
                         print(f"Image compressed: quality={quality}, size={buf.tell() / 1024:.0f}KB")
-                    buf.seek(0)
-                    return buf.read()
+                    return buf.getvalue()
 
             # If still too large, resize further
             while img.width > 512 or img.height > 512:
@@ -133,11 +140,9 @@ for line in tail_f(STDIN_FILE):
                 img.save(buf, format="JPEG", quality=50, optimize=True)
                 print(f"Image resized further: {prev_size} -> {img.size}, size={buf.tell() / 1024:.0f}KB")
                 if buf.tell() <= max_size_bytes:
-                    buf.seek(0)
-                    return buf.read()
+                    return buf.getvalue()
 
-            buf.seek(0)
-            return buf.read()
+            return buf.getvalue()
 
         for name, obj in list(globals.items()):
             if isinstance(obj, PILImage.Image):
@@ -11,10 +11,13 @@ from cachetools import TTLCache
 from agents.coding_sandbox import ModalSandbox
 
 # TTL caches for per-user isolation (30 min TTL matches Modal's idle timeout)
+# Both are bounded: least recently used users are evicted once maxsize is reached
 # user_id -> ModalSandbox
 user_sandboxes: TTLCache[str, ModalSandbox] = TTLCache(maxsize=1000, ttl=1800)
 # user_id -> list of messages
 user_messages: TTLCache[str, list] = TTLCache(maxsize=1000, ttl=1800)
+# Per-user history cap; older turns are dropped as new ones start (see _trim_history)
+MAX_HISTORY_MESSAGES = 200
 # Lock for thread-safe sandbox operations
 _sandbox_lock = threading.Lock()
 
@@ -47,16 +50,58 @@ def reset_sandbox(user_id: str) -> None:
 
 
 def get_messages(user_id: str) -> list:
-    """Get or create the message list for a user."""
-    if user_id not in user_messages:
-        user_messages[user_id] = []
-    return user_messages[user_id]
+    """Get or create the message list for a user.
+
+    Re-setting the entry on every access makes the TTL sliding, so an active
+    conversation never expires mid-chat while idle ones still age out.
+    """
+    messages = user_messages.get(user_id)
+    if messages is None:
+        messages = []
+    user_messages[user_id] = messages
+    return messages
+
+
+def ensure_system_prompt(user_id: str, prompt: str) -> None:
+    """Put the system prompt at the start of a user's history if it isn't there yet."""
+    messages = get_messages(user_id)
+    if not messages or not _is_system_message(messages[0]):
+        messages.insert(0, {"role": "system", "content": prompt})
+
+
+def append_message(user_id: str, message: dict) -> None:
+    """Append a message to a user's history (trimming old turns when a new one starts)."""
+    messages = get_messages(user_id)
+    messages.append(message)
+    if message.get("role") == "user":
+        _trim_history(messages)
+
+
+def _is_system_message(message) -> bool:
+    return isinstance(message, dict) and message.get("role") == "system"
+
+
+def _is_user_message(message) -> bool:
+    return isinstance(message, dict) and message.get("role") == "user"
+
+
+def _trim_history(messages: list) -> None:
+    """Drop the oldest turns in place until the history fits MAX_HISTORY_MESSAGES.
+
+    Whole turns (user message up to the next one) are dropped so a tool call is never
+    separated from its result, and a leading system prompt is always kept.
+    """
+    start = 1 if messages and _is_system_message(messages[0]) else 0
+    while len(messages) > MAX_HISTORY_MESSAGES:
+        next_turn = next((i for i in range(start + 1, len(messages)) if _is_user_message(messages[i])), None)
+        if next_turn is None:
+            return  # A single turn bigger than the cap - leave it whole
+        del messages[start:next_turn]
 
 
 def clear_messages(user_id: str) -> None:
-    """Clear the message list for a user."""
-    if user_id in user_messages:
-        del user_messages[user_id]
+    """Clear the message list for a user (they get a fresh, empty one)."""
+    user_messages[user_id] = []
 
 
 async def init_sandbox(user_id: str) -> None:
@@ -1,6 +1,7 @@
 # ruff: noqa: F401
 """UI components for the agent chat interface."""
 
+from agents.ui.images import image_src, store_images, refresh_images, get_image, clear_images
 from agents.ui.markdown import render_md
 from agents.ui.tool_renderers import TOOL_RENDERERS, render_tool_call
 from agents.ui.components import (
@@ -12,6 +13,7 @@ from agents.ui.components import (
     TraceView,
     TraceUpdate,
     TraceAppend,
+    clear_trace_cache,
     ThinkingIndicator,
     TokenCountUpdate,
     is_usage_update,
@@ -4,29 +4,35 @@ Reusable UI components for the agent chat interface.
 """
 
 import json
+import threading
+from functools import lru_cache
+from hashlib import blake2b
+
+from cachetools import TTLCache
+
 from fasthtml.common import *
+from agents.ui.images import image_src
 from agents.ui.markdown import render_md
 from agents.ui.tool_renderers import render_tool_call
 
 
 # ============ Message Type Helpers ============
+# Stream events from run_agent are always plain dicts
 
 
 def is_usage_update(msg):
     """Check if message is a usage update."""
-    return isinstance(msg, dict) and msg.get("type") == "usage"
+    return msg.get("type") == "usage"
 
 
 def is_final_response(msg):
     """Check if message is the final assistant response (no tool calls)."""
-    role = msg.get("role") if isinstance(msg, dict) else getattr(msg, "role", None)
-    tool_calls = msg.get("tool_calls") if isinstance(msg, dict) else getattr(msg, "tool_calls", None)
-    return role == "assistant" and not tool_calls
+    return msg.get("role") == "assistant" and not msg.get("tool_calls")
 
 
 def is_tool_result(msg):
     """Check if message is a tool result."""
-    return isinstance(msg, dict) and msg.get("role") == "tool"
+    return msg.get("role") == "tool"
 
 
 def get_images_from_tool_result(msg):
@@ -45,6 +51,12 @@ def get_plotly_htmls_from_tool_result(msg):
     return [block.get("html") for block in content if block.get("type") == "plotly_html"]
 
 
+@lru_cache(maxsize=1024)
+def _modal_id(prefix: str, img_url: str) -> str:
+    """Stable DOM id for an image modal (builtin hash() is salted per process and collides mod 1e5)."""
+    return f"{prefix}-{blake2b(img_url.encode(), digest_size=4).hexdigest()}"
+
+
 def ChatMessage(role: str, content: str):
     """Render a chat message bubble."""
     is_user = role == "user"
@@ -59,174 +71,221 @@ def ChatMessage(role: str, content: str):
     )
 
 
+# Color coding by role
+ROLE_COLORS = {
+    "system": "badge-warning",
+    "user": "badge-primary",
+    "assistant": "badge-secondary",
+    "tool": "badge-accent",
+}
+
+
+def _trace_entry(role, content):
+    """Wrap rendered message content with the role badge used in the trace view."""
+    badge_cls = ROLE_COLORS.get(role, "badge-ghost")
+    return Div(
+        Div(Span(role.upper(), cls=f"badge {badge_cls} badge-sm"), cls="mb-1"),
+        content,
+        cls="border-l-2 border-base-300 pl-3 pr-3 py-2 mb-2",
+    )
+
+
+# Pre styles shared by the trace renderers
+_PRE_CLS = "text-xs whitespace-pre-wrap bg-base-300 p-2 rounded"
+_PRE_SCROLL_CLS = f"{_PRE_CLS} max-h-32 overflow-y-auto"
+_SYSTEM_PRE_CLS = f"{_PRE_CLS} overflow-x-auto max-h-40 overflow-y-auto"
+
+
+@lru_cache(maxsize=8)
+def _render_system_message(content: str):
+    """Render a system message to HTML once. The system prompt is constant, so every trace reuses it."""
+    return NotStr(to_xml(_trace_entry("system", Pre(content, cls=_SYSTEM_PRE_CLS))))
+
+
 def TraceMessage(msg):
     """Render a single message in the trace view with full detail."""
+    rendered = _render_trace_message(msg)
+    return rendered if isinstance(rendered, NotStr) else NotStr(to_xml(rendered))
+
+
+# user_id -> {id(msg): (msg, html)} for the messages in that user's current history.
+# Messages aren't mutated once they're in the history, so TraceUpdate re-renders of a
+# long conversation only pay for new messages. Each render replaces the user's entry
+# (never mutating a shared dict, so the /chat threadpool and the event loop can't race)
+# and keeps only messages still in the history, so trimmed or cleared ones are released.
+# The msg is kept with its HTML so a reused id can't match. Same 30 min TTL as the history.
+user_traces: TTLCache[str, dict[int, tuple]] = TTLCache(maxsize=1000, ttl=1800)
+_user_traces_lock = threading.Lock()
+
+
+def clear_trace_cache(user_id: str) -> None:
+    """Drop a user's rendered trace entries (their chat was cleared)."""
+    with _user_traces_lock:
+        user_traces.pop(user_id, None)
+
+
+def _render_trace_message(msg):
     role = msg.get("role", "unknown")
+    if role == "system" and isinstance(msg.get("content"), str):
+        return _render_system_message(msg["content"])
+    render = TRACE_RENDERERS.get(role, _trace_other)
+    return _trace_entry(role, render(msg))
 
-    # Color coding by role
-    role_colors = {
-        "system": "badge-warning",
-        "user": "badge-primary",
-        "assistant": "badge-secondary",
-        "tool": "badge-accent",
-    }
-    badge_cls = role_colors.get(role, "badge-ghost")
-
-    # Handle different message types
-    if role == "system":
-        content = Pre(
-            msg.get("content", ""),
-            cls="text-xs whitespace-pre-wrap bg-base-300 p-2 rounded overflow-x-auto max-h-40 overflow-y-auto",
-        )
-    elif role == "user":
-        content = Pre(
-            msg.get("content", ""),
-            cls="text-xs whitespace-pre-wrap bg-base-300 p-2 rounded",
-        )
-    elif role == "assistant":
-        # Check if it has tool_calls (could be a ChatCompletionMessage object or dict)
-        tool_calls = getattr(msg, "tool_calls", None) or msg.get("tool_calls")
-        if tool_calls:
-            # Assistant message with tool calls
-            parts = []
-
-            # Show assistant content if present (some models include text alongside tool calls)
-            msg_content = getattr(msg, "content", None) or msg.get("content")
-            if msg_content:
-                parts.append(
-                    Pre(
-                        msg_content,
-                        cls="text-xs whitespace-pre-wrap bg-base-300 p-2 rounded mb-2",
-                    )
-                )
 
-            calls_display = []
-            for tc in tool_calls:
-                # Handle both object and dict formats
-                if hasattr(tc, "function"):
-                    name = tc.function.name
-                    args = tc.function.arguments
-                    tc_id = tc.id
-                else:
-                    name = tc.get("function", {}).get("name", "?")
-                    args = tc.get("function", {}).get("arguments", "{}")
-                    tc_id = tc.get("id", "?")
-
-                calls_display.append(render_tool_call(name, args, tc_id))
-
-            # Parallel calls: display side-by-side in a grid
-            if len(calls_display) > 1:
-                parts.append(
-                    Div(
-                        Span("⚡ parallel", cls="text-xs opacity-50 mb-1 block"),
-                        Div(*calls_display, cls="grid grid-cols-2 gap-2"),
-                    )
-                )
-            else:
-                parts.extend(calls_display)
+def _trace_system(msg):
+    return Pre(msg.get("content", ""), cls=_SYSTEM_PRE_CLS)
 
-            content = Div(*parts)
-        else:
-            # Regular assistant response
-            content = Pre(
-                msg.get("content", ""),
-                cls="text-xs whitespace-pre-wrap bg-base-300 p-2 rounded",
+
+def _trace_user(msg):
+    return Pre(msg.get("content", ""), cls=_PRE_CLS)
+
+
+def _trace_assistant(msg):
+    # Check if it has tool_calls (could be a ChatCompletionMessage object or dict)
+    tool_calls = getattr(msg, "tool_calls", None) or msg.get("tool_calls")
+    if tool_calls:
+        # Assistant message with tool calls
+        parts = []
+
+        # Show assistant content if present (some models include text alongside tool calls)
+        msg_content = getattr(msg, "content", None) or msg.get("content")
+        if msg_content:
+            parts.append(Pre(msg_content, cls=f"{_PRE_CLS} mb-2"))
+
+        calls_display = []
+        for tc in tool_calls:
+            # Handle both object and dict formats
+            if hasattr(tc, "function"):
+                name = tc.function.name
+                args = tc.function.arguments
+                tc_id = tc.id
+            else:
+                name = tc.get("function", {}).get("name", "?")
+                args = tc.get("function", {}).get("arguments", "{}")
+                tc_id = tc.get("id", "?")
+
+            calls_display.append(render_tool_call(name, args, tc_id))
+
+        # Parallel calls: display side-by-side in a grid
+        if len(calls_display) > 1:
+            parts.append(
+                Div(
+                    Span("⚡ parallel", cls="text-xs opacity-50 mb-1 block"),
+                    Div(*calls_display, cls="grid grid-cols-2 gap-2"),
+                )
             )
-    elif role == "tool":
-        tool_call_id = msg.get("tool_call_id", "?")
-        msg_content = msg.get("content", "")
-
-        # Handle content blocks (list) vs plain string
-        if isinstance(msg_content, list):
-            text_parts = []
-            image_parts = []
-            plotly_parts = []
-            for block in msg_content:
-                if block.get("type") == "text":
-                    text_parts.append(
-                        Pre(
-                            block.get("text", ""),
-                            cls="text-xs whitespace-pre-wrap bg-base-300 p-2 rounded max-h-32 overflow-y-auto",
-                        )
-                    )
-                elif block.get("type") == "image_url":
-                    # Render image as thumbnail with DaisyUI modal for expansion
-                    img_url = block.get("image_url", "")
-                    modal_id = f"img-modal-{hash(img_url) % 100000}"
-                    image_parts.append(
-                        Div(
-                            Img(
-                                src=img_url,
-                                cls="w-full h-auto rounded border border-base-300 cursor-pointer hover:opacity-80",
-                                onclick=f"document.getElementById('{modal_id}').showModal()",
-                            ),
-                            Dialog(
-                                Div(
-                                    Img(src=img_url, cls="max-h-[80vh] max-w-full object-contain"),
-                                    cls="modal-box w-fit max-w-[90vw] p-4 bg-base-300",
-                                ),
-                                Form(Button("", cls="cursor-default"), method="dialog", cls="modal-backdrop bg-neutral/80"),
-                                id=modal_id,
-                                cls="modal modal-middle",
+        else:
+            parts.extend(calls_display)
+
+        return Div(*parts)
+
+    # Regular assistant response
+    return Pre(msg.get("content", ""), cls=_PRE_CLS)
+
+
+def _trace_tool(msg):
+    tool_call_id = msg.get("tool_call_id", "?")
+    msg_content = msg.get("content", "")
+
+    # Handle content blocks (list) vs plain string
+    if isinstance(msg_content, list):
+        text_parts = []
+        image_parts = []
+        plotly_parts = []
+        for block in msg_content:
+            if block.get("type") == "text":
+                text_parts.append(Pre(block.get("text", ""), cls=_PRE_SCROLL_CLS))
+            elif block.get("type") == "image_url":
+                # Render image as thumbnail with DaisyUI modal for expansion
+                img_url = image_src(block.get("image_url", ""))
+                modal_id = _modal_id("img-modal", img_url)
+                image_parts.append(
+                    Div(
+                        Img(
+                            src=img_url,
+                            cls="w-full h-auto rounded border border-base-300 cursor-pointer hover:opacity-80",
+                            onclick=f"document.getElementById('{modal_id}').showModal()",
+                        ),
+                        Dialog(
+                            Div(
+                                Img(src=img_url, cls="max-h-[80vh] max-w-full object-contain"),
+                                cls="modal-box w-fit max-w-[90vw] p-4 bg-base-300",
                             ),
-                        )
-                    )
-                elif block.get("type") == "plotly_html":
-                    # Render interactive Plotly chart in iframe (scripts execute in iframe)
-                    html = block.get("html", "")
-                    plotly_parts.append(
-                        Iframe(
-                            srcdoc=f"<!DOCTYPE html><html><head><style>body{{margin:0}}</style></head><body>{html}</body></html>",
-                            cls="w-full h-80 border-0 rounded bg-base-100",
-                        )
+                            Form(Button("", cls="cursor-default"), method="dialog", cls="modal-backdrop bg-neutral/80"),
+                            id=modal_id,
+                            cls="modal modal-middle",
+                        ),
                     )
-
-            # Build content with text parts, image grid, and plotly charts
-            parts = text_parts
-            if image_parts:
-                # Grid: 2 columns for image thumbnails
-                parts.append(
-                    Div(
-                        *image_parts,
-                        cls="grid grid-cols-2 gap-2 my-2",
+                )
+            elif block.get("type") == "plotly_html":
+                # Render interactive Plotly chart in iframe (scripts execute in iframe)
+                html = block.get("html", "")
+                plotly_parts.append(
+                    Iframe(
+                        srcdoc=f"<!DOCTYPE html><html><head><style>body{{margin:0}}</style></head><body>{html}</body></html>",
+                        cls="w-full h-80 border-0 rounded bg-base-100",
                     )
                 )
-            if plotly_parts:
-                # Plotly charts full width (not in grid)
-                parts.extend([Div(p, cls="my-2") for p in plotly_parts])
 
-            content = Div(
-                Span(f"tool_call_id: {tool_call_id}", cls="text-xs opacity-50 block mb-1"),
-                *parts,
-            )
-        else:
-            # Plain string content (backwards compatible)
-            content = Div(
-                Span(f"tool_call_id: {tool_call_id}", cls="text-xs opacity-50 block mb-1"),
-                Pre(
-                    msg_content,
-                    cls="text-xs whitespace-pre-wrap bg-base-300 p-2 rounded max-h-32 overflow-y-auto",
-                ),
+        # Build content with text parts, image grid, and plotly charts
+        parts = text_parts
+        if image_parts:
+            # Grid: 2 columns for image thumbnails
+            parts.append(
+                Div(
+                    *image_parts,
+                    cls="grid grid-cols-2 gap-2 my-2",
+                )
             )
-    else:
-        content = Pre(
-            json.dumps(msg, indent=2, default=str),
-            cls="text-xs bg-base-300 p-2 rounded",
+        if plotly_parts:
+            # Plotly charts full width (not in grid)
+            parts.extend([Div(p, cls="my-2") for p in plotly_parts])
+
+        return Div(
+            Span(f"tool_call_id: {tool_call_id}", cls="text-xs opacity-50 block mb-1"),
+            *parts,
         )
 
+    # Plain string content (backwards compatible)
     return Div(
-        Div(Span(role.upper(), cls=f"badge {badge_cls} badge-sm"), cls="mb-1"),
-        content,
-        cls="border-l-2 border-base-300 pl-3 pr-3 py-2 mb-2",
+        Span(f"tool_call_id: {tool_call_id}", cls="text-xs opacity-50 block mb-1"),
+        Pre(msg_content, cls=_PRE_SCROLL_CLS),
     )
 
 
-def TraceView(messages):
-    """Render the full message trace."""
+def _trace_other(msg):
+    return Pre(json.dumps(msg, indent=2, default=str), cls="text-xs bg-base-300 p-2 rounded")
+
+
+# Trace body renderer per role (unknown roles fall back to a JSON dump)
+TRACE_RENDERERS = {
+    "system": _trace_system,
+    "user": _trace_user,
+    "assistant": _trace_assistant,
+    "tool": _trace_tool,
+}
+
+
+# What every new or cleared chat shows in the trace panel
+_EMPTY_TRACE = NotStr(to_xml(Div(Span("No messages yet", cls="text-sm opacity-50"), cls="p-4")))
+
+
+def TraceView(messages, user_id: str | None = None):
+    """Render the full message trace (reusing the user's already rendered messages if given)."""
     if not messages:
-        return Div(Span("No messages yet", cls="text-sm opacity-50"), cls="p-4")
+        return _EMPTY_TRACE
+    if user_id is None:
+        return Div(*[TraceMessage(m) for m in messages], cls="p-4")
 
-    return Div(*[TraceMessage(m) for m in messages], cls="p-4")
+    with _user_traces_lock:
+        cached = user_traces.get(user_id, {})
+    rendered = {}
+    for m in messages:
+        hit = cached.get(id(m))
+        rendered[id(m)] = hit if hit is not None and hit[0] is m else (m, TraceMessage(m))
+    with _user_traces_lock:
+        user_traces[user_id] = rendered
+    return Div(*[rendered[id(m)][1] for m in messages], cls="p-4")
 
 
 def ChatInput():
@@ -268,21 +327,24 @@ def ThinkingIndicator():
     )
 
 
-def TraceUpdate(messages):
+def TraceUpdate(messages, user_id: str | None = None):
     """OOB swap to update trace panel."""
     return Div(
-        TraceView(messages),
+        TraceView(messages, user_id),
         id="trace-container",
         hx_swap_oob="true",
         cls="overflow-y-auto flex-1 min-h-0",
     )
 
 
+# Scrolls the trace to the bottom once an appended message loads (same for every append)
+_SCROLL_TO_BOTTOM = {"hx-on::load": "let c = document.getElementById('trace-container'); c.scrollTop = c.scrollHeight;"}
+
+
 def TraceAppend(msg):
     """Append a message to trace with auto-scroll to bottom."""
-    scroll_js = "let c = document.getElementById('trace-container'); c.scrollTop = c.scrollHeight;"
     return Div(
-        Div(TraceMessage(msg), **{"hx-on::load": scroll_js}),
+        Div(TraceMessage(msg), **_SCROLL_TO_BOTTOM),
         id="trace-container",
         hx_swap_oob="beforeend",
     )
@@ -304,8 +366,9 @@ def ChatImages(images):
         return None
 
     image_elements = []
-    for img_url in images:
-        modal_id = f"chat-img-modal-{hash(img_url) % 100000}"
+    for url in images:
+        img_url = image_src(url)
+        modal_id = _modal_id("chat-img-modal", img_url)
         image_elements.append(
             Div(
                 Img(
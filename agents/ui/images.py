@@ -0,0 +1,107 @@
+"""
+Per-user store for images shown in the UI.
+
+Tool results carry images as base64 data URIs (the LLM needs them inline), but embedding
+those in every chat/trace render bloats the HTML. When a tool result streams in, its
+images are stored here under the user who ran it, and <img> tags point at the short
+/img/{key} route served by main.py (which only hands them back to that user).
+
+Like messages and sandboxes, the store lives in process memory: with several workers
+the proxy has to pin sessions.
+"""
+
+import base64
+import binascii
+import threading
+from hashlib import blake2b
+
+from cachetools import LRUCache, TTLCache
+
+# user_id -> {key -> (media type, image bytes)}; same 30 min sliding TTL as the message history
+user_images: TTLCache[str, LRUCache] = TTLCache(maxsize=1000, ttl=1800)
+# Per-user cap. An evicted image the history still shows is stored again from the
+# history when requested (see the /img route in main.py)
+MAX_IMAGES_PER_USER = 256
+
+# data URI -> key for recently seen images. One tool result is stored, then rendered in
+# the chat and the trace; images can be MBs, so only the first of those decodes and hashes.
+# (str hashes are cached on the object, so looking up the same URL again is O(1).)
+_image_keys: LRUCache[str, str | None] = LRUCache(maxsize=32)
+_image_keys_lock = threading.Lock()
+
+
+def _decode_data_uri(url: str) -> tuple[str, str, bytes] | None:
+    """Split a base64 data URI into (key, media type, bytes), or None for anything else."""
+    if not url.startswith("data:"):
+        return None
+    header, sep, payload = url.partition(",")
+    media_type, _, encoding = header[len("data:") :].partition(";")
+    if not sep or encoding != "base64":
+        return None
+    try:
+        data = base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return blake2b(data, digest_size=8).hexdigest(), media_type or "application/octet-stream", data
+
+
+def _remember_key(url: str, key: str | None) -> None:
+    with _image_keys_lock:
+        _image_keys[url] = key
+
+
+def _image_key(url: str) -> str | None:
+    """The store key for a base64 data URI (None if it isn't one), decoding only on a miss."""
+    if not url.startswith("data:"):
+        return None
+    with _image_keys_lock:
+        if url in _image_keys:
+            return _image_keys[url]
+    decoded = _decode_data_uri(url)
+    key = None if decoded is None else decoded[0]
+    _remember_key(url, key)
+    return key
+
+
+def image_src(url: str) -> str:
+    """Return the URL an <img> should use: /img/{key} for base64 data URIs, else the URL unchanged."""
+    key = _image_key(url)
+    return url if key is None else f"/img/{key}"
+
+
+def _user_store(user_id: str) -> LRUCache | None:
+    # Re-setting the entry on access keeps the TTL sliding, like get_messages
+    images = user_images.get(user_id)
+    if images is not None:
+        user_images[user_id] = images
+    return images
+
+
+def store_images(user_id: str, urls) -> None:
+    """Keep a user's data URI images so image_src URLs resolve for them."""
+    images = _user_store(user_id)
+    for url in urls:
+        decoded = _decode_data_uri(url)
+        if decoded is None:
+            continue
+        _remember_key(url, decoded[0])
+        if images is None:
+            images = user_images[user_id] = LRUCache(maxsize=MAX_IMAGES_PER_USER)
+        key, media_type, data = decoded
+        images[key] = (media_type, data)
+
+
+def refresh_images(user_id: str) -> None:
+    """Push back the expiry of a user's images (call it wherever their history is accessed)."""
+    _user_store(user_id)
+
+
+def get_image(user_id: str, key: str) -> tuple[str, bytes] | None:
+    """Look up one of a user's stored images as (media type, bytes)."""
+    images = _user_store(user_id)
+    return None if images is None else images.get(key)
+
+
+def clear_images(user_id: str) -> None:
+    """Drop a user's stored images (their chat was cleared)."""
+    user_images.pop(user_id, None)
@@ -51,10 +51,12 @@ def apply_classes(html_str, class_map=None):
     try:
         doc = lxml_html.fragment_fromstring(html_str, create_parent="div")
 
-        for tag, classes in class_map.items():
-            for elem in doc.xpath(f".//{tag}"):
+        # One pass over the tree for all mapped tags (not one XPath query per tag).
+        # iterdescendants() with no tags visits everything, hence the guard.
+        if class_map:
+            for elem in doc.iterdescendants(*class_map):
                 existing = elem.get("class", "")
-                elem.set("class", f"{existing} {classes}".strip())
+                elem.set("class", f"{existing} {class_map[elem.tag]}".strip())
 
         result = lxml_html.tostring(doc, encoding="unicode")
         if result.startswith("<div>") and result.endswith("</div>"):
@@ -64,10 +66,14 @@ def apply_classes(html_str, class_map=None):
         return html_str
 
 
+_HIGHLIGHT_DIV_RE = re.compile(r'<div class="highlight"[^>]*>')
+_PRE_RE = re.compile(r"<pre[^>]*>")
+
+
 def _strip_pygments_styles(html_str):
     """Strip inline styles from Pygments output so Tailwind classes can apply."""
-    html_str = re.sub(r'<div class="highlight"[^>]*>', '<div class="highlight">', html_str)
-    html_str = re.sub(r"<pre[^>]*>", "<pre>", html_str)
+    html_str = _HIGHLIGHT_DIV_RE.sub('<div class="highlight">', html_str)
+    html_str = _PRE_RE.sub("<pre>", html_str)
     return html_str
 
 
@@ -6,6 +6,8 @@ Each renderer takes (name, args_dict) and returns an FT component.
 """
 
 import json
+from functools import lru_cache
+
 from fasthtml.common import *
 from agents.ui.markdown import render_md
 
@@ -27,7 +29,22 @@ TOOL_RENDERERS = {
 
 
 def render_tool_call(name, args_str, tc_id):
-    """Render a tool call, using custom renderer if available."""
+    """Render a tool call, using custom renderer if available.
+
+    Tool calls never change once made, but the trace re-renders them on every update,
+    so calls with JSON string arguments are rendered to HTML once and cached.
+    """
+    if isinstance(args_str, str):
+        return _render_tool_call_cached(name, args_str, tc_id)
+    return _render_tool_call(name, args_str, tc_id)
+
+
+@lru_cache(maxsize=512)
+def _render_tool_call_cached(name, args_str, tc_id):
+    return NotStr(to_xml(_render_tool_call(name, args_str, tc_id)))
+
+
+def _render_tool_call(name, args_str, tc_id):
     try:
         args_dict = json.loads(args_str) if isinstance(args_str, str) else args_str
     except json.JSONDecodeError:
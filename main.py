@@ -1,4 +1,3 @@
-# ruff: noqa: F403, F405
 """
 Agent Chat Web App
 
@@ -6,12 +5,42 @@ A hackable interface for working with agents - see chat, tool calls, and traces.
 """
 
 import asyncio
+import os
+import sys
 import uuid
+import weakref
+
+import uvicorn
 
 from dotenv import load_dotenv
-from fasthtml.common import *
+from fasthtml.common import (
+    H1,
+    Beforeware,
+    Button,
+    Div,
+    EventStream,
+    Link,
+    Nav,
+    NotStr,
+    Response,
+    Script,
+    Span,
+    Style,
+    Title,
+    fast_app,
+    serve,
+    sse_message,
+    to_xml,
+)
 from agents.agent import run_agent
-from agents.tools import init_sandbox, get_messages, clear_messages, reset_sandbox
+from agents.tools import (
+    init_sandbox,
+    get_messages,
+    clear_messages,
+    reset_sandbox,
+    ensure_system_prompt,
+    append_message,
+)
 from agents.ui import (
     ChatMessage,
     ChatInput,
@@ -20,6 +49,7 @@ from agents.ui import (
     TraceView,
     TraceUpdate,
     TraceAppend,
+    clear_trace_cache,
     ThinkingIndicator,
     TokenCountUpdate,
     is_usage_update,
@@ -27,6 +57,10 @@ from agents.ui import (
     is_tool_result,
     get_images_from_tool_result,
     get_plotly_htmls_from_tool_result,
+    store_images,
+    refresh_images,
+    get_image,
+    clear_images,
 )
 from agents.prompts import SYSTEM_PROMPT
 
@@ -67,19 +101,12 @@ app, rt = fast_app(
 )
 
 
-# ============ Routes ============
-
+# ============ Layout ============
 
-@rt("/", methods=["GET"])
-async def index(req):
-    user_id = req.state.user_id
-    # Clear messages on page load (refresh = clear)
-    clear_messages(user_id)
-    messages = get_messages(user_id)
-    # Initialize sandbox in background (terminate old, create new)
-    asyncio.create_task(init_sandbox(user_id))
 
-    return Title("FastAgent"), Div(
+def AppShell(trace):
+    """The full page layout: navbar, chat on the left, message trace on the right."""
+    return Div(
         # Header - DaisyUI navbar
         Nav(
             Div(H1("Agent Chat", cls="text-xl font-bold"), cls="navbar-start"),
@@ -124,7 +151,7 @@ async def index(req):
                     cls="p-3 border-b border-base-300 bg-base-100 sticky top-0",
                 ),
                 Div(
-                    TraceView(messages),
+                    trace,
                     id="trace-container",
                     cls="overflow-y-auto flex-1 min-h-0",
                 ),
@@ -136,13 +163,162 @@ async def index(req):
     )
 
 
+# Loading the page always starts a fresh chat, so the whole page body is rendered once
+_INDEX_BODY = NotStr(to_xml(AppShell(TraceView([]))))
+
+
+# ============ Helpers ============
+
+_DONE = object()
+
+
+async def coalesce(events, window: float = 0.005, keepalive: float | None = None):
+    """Group events from an async generator that arrive within `window` seconds of each other.
+
+    Yields lists of events. A batch is flushed once the window passes with nothing new,
+    or immediately after a final response so the stream can close without waiting.
+    With `keepalive` set, an empty list is yielded after that many idle seconds.
+    """
+    queue = asyncio.Queue()
+
+    async def produce():
+        try:
+            async for item in events:
+                await queue.put(item)
+        finally:
+            await queue.put(_DONE)
+
+    producer = asyncio.create_task(produce())
+    try:
+        done = False
+        while not done:
+            try:
+                batch = [await asyncio.wait_for(queue.get(), keepalive)]
+            except TimeoutError:
+                yield []
+                continue
+            while batch[-1] is not _DONE and not is_final_response(batch[-1]):
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), window))
+                except TimeoutError:
+                    break
+            if batch[-1] is _DONE:
+                done = True
+                batch.pop()
+            if batch:
+                yield batch
+        await producer  # Re-raise anything the agent loop raised
+    finally:
+        producer.cancel()
+
+
+# SSE framing for agent events, pre-encoded (frames are written as bytes)
+_AGENT_EVENT_PREFIX = b"event: AgentEvent\ndata: "
+_CLOSE_FRAME = sse_message(Div(), event="close").encode()
+# SSE comment line; keeps idle connections (long tool runs) from being dropped by proxies
+_PING_FRAME = b": ping\n\n"
+
+
+def agent_event(fragments) -> bytes:
+    """Encode a tuple of OOB fragments as one AgentEvent SSE frame (same framing as sse_message)."""
+    html = to_xml(fragments, indent=False).replace("\r\n", "\n").replace("\r", "\n")
+    return _AGENT_EVENT_PREFIX + html.replace("\n", "\ndata: ").encode() + b"\n\n"
+
+
+# Background sandbox inits: capped so a burst of page reloads can't flood Modal, and the
+# task references are kept so they aren't garbage collected while running
+_SANDBOX_INIT_CONCURRENCY = 16
+_sandbox_init_tasks: set[asyncio.Task] = set()
+# The cap's semaphore per event loop (a semaphore binds to the loop that first waits on it)
+_sandbox_init_limits: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = weakref.WeakKeyDictionary()
+
+
+def _sandbox_init_limit() -> asyncio.Semaphore:
+    """The sandbox init semaphore for the running event loop, created on first use."""
+    loop = asyncio.get_running_loop()
+    limit = _sandbox_init_limits.get(loop)
+    if limit is None:
+        limit = _sandbox_init_limits[loop] = asyncio.Semaphore(_SANDBOX_INIT_CONCURRENCY)
+    return limit
+
+
+def start_sandbox_init(user_id: str) -> None:
+    """Initialize a user's sandbox in the background (terminate old, create new)."""
+
+    async def bounded_init():
+        async with _sandbox_init_limit():
+            # Created only once a slot is free, so a task cancelled while waiting
+            # (e.g. at shutdown) leaves no never-awaited coroutine behind
+            await init_sandbox(user_id)
+
+    task = asyncio.create_task(bounded_init())
+    _sandbox_init_tasks.add(task)
+    task.add_done_callback(_sandbox_init_done)
+
+
+def _sandbox_init_done(task: asyncio.Task) -> None:
+    _sandbox_init_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        print(f"Sandbox init failed: {task.exception()!r}", file=sys.stderr)
+
+
+def stream_fragments(msg, user_id: str):
+    """OOB fragments that apply one agent event to the page (frames are flat tuples of these)."""
+    if is_usage_update(msg):
+        # Usage update: update token count
+        return (TokenCountUpdate(msg["total"]),)
+    if is_final_response(msg):
+        # Final response: append to chat, clear thinking indicator, append to trace
+        return (
+            Div(ChatMessage("assistant", msg["content"]), id="chat-container", hx_swap_oob="beforeend"),
+            Div(id="response-area", hx_swap_oob="true"),
+            TraceAppend(msg),
+        )
+    # Intermediate (tool calls or tool results): append to trace
+    # Also show images/charts in chat if this is a tool result with visuals
+    if is_tool_result(msg):
+        images = get_images_from_tool_result(msg)
+        # Stored before rendering so the chat and trace /img/{key} URLs resolve for this user
+        store_images(user_id, images)
+        plotly_htmls = get_plotly_htmls_from_tool_result(msg)
+        if images or plotly_htmls:
+            chat_visuals = []
+            if images:
+                chat_visuals.append(ChatImages(images))
+            if plotly_htmls:
+                chat_visuals.append(ChatPlotly(plotly_htmls))
+            return (
+                Div(*chat_visuals, id="chat-container", hx_swap_oob="beforeend"),
+                TraceAppend(msg),
+            )
+    return (TraceAppend(msg),)
+
+
+# ============ Routes ============
+
+
+@rt("/", methods=["GET"])
+async def index(req):
+    user_id = req.state.user_id
+    # Clear messages on page load (refresh = clear)
+    clear_messages(user_id)
+    clear_images(user_id)
+    clear_trace_cache(user_id)
+    # Initialize sandbox in background (terminate old, create new)
+    start_sandbox_init(user_id)
+
+    return Title("FastAgent"), _INDEX_BODY
+
+
 @rt("/clear", methods=["POST"])
 async def clear_chat(req):
     user_id = req.state.user_id
     clear_messages(user_id)
+    clear_images(user_id)
+    clear_trace_cache(user_id)
     reset_sandbox(user_id)
     # Initialize sandbox in background (terminate old, create new)
-    asyncio.create_task(init_sandbox(user_id))
+    start_sandbox_init(user_id)
     return (
         "",  # Clear chat container
         Div(
@@ -158,16 +334,17 @@ async def clear_chat(req):
 @rt("/chat", methods=["POST"])
 def send_message(req, message: str):
     user_id = req.state.user_id
-    messages = get_messages(user_id)
     if not message.strip():
         return ""
 
     # Ensure system prompt exists (so trace shows it before agent runs)
-    if not messages or messages[0].get("role") != "system":
-        messages.insert(0, {"role": "system", "content": SYSTEM_PROMPT})
+    ensure_system_prompt(user_id, SYSTEM_PROMPT)
 
     # Add user message to history
-    messages.append({"role": "user", "content": message})
+    append_message(user_id, {"role": "user", "content": message})
+    messages = get_messages(user_id)
+    # The trace re-renders /img links for the whole history, so its images live as long as it does
+    refresh_images(user_id)
 
     # Return user message + SSE container + trace update (shows system + user)
     return (
@@ -184,68 +361,65 @@ def send_message(req, message: str):
             id="response-area",
             hx_swap_oob="true",
         ),
-        TraceUpdate(messages),
+        TraceUpdate(messages, user_id),
     )
 
 
+@rt("/img/{key}", methods=["GET"])
+def image(req, key: str):
+    """Serve an image stored from one of this user's tool results (see agents/ui/images.py)."""
+    # Looked up in the session user's own store, so a key alone can't fetch someone else's image
+    user_id = req.state.user_id
+    found = get_image(user_id, key)
+    if found is None:
+        # Expired or evicted from the store while the history still shows it: store the
+        # history's images again, so no /img link on the page goes dead before its message
+        history_images = [url for msg in get_messages(user_id) if is_tool_result(msg) for url in get_images_from_tool_result(msg)]
+        store_images(user_id, history_images)
+        found = get_image(user_id, key)
+    if found is None:
+        return Response(status_code=404)
+    media_type, data = found
+    # Keys are content hashes, so the bytes behind a URL never change
+    return Response(data, media_type=media_type, headers={"Cache-Control": "private, max-age=86400, immutable"})
+
+
 @rt("/agent-stream", methods=["GET"])
 async def agent_stream(req):
     """SSE endpoint that streams agent messages."""
     user_id = req.state.user_id
     messages = get_messages(user_id)
+    refresh_images(user_id)
 
     async def event_stream():
-        for msg in run_agent(messages, user_id):
-            if is_usage_update(msg):
-                # Usage update: update token count
-                yield sse_message(TokenCountUpdate(msg["total"]), event="AgentEvent")
-                await asyncio.sleep(0.01)
-            elif is_final_response(msg):
-                # Final response: append to chat, clear thinking indicator, append to trace
-                content = msg.get("content") if isinstance(msg, dict) else msg.content
-                yield sse_message(
-                    Div(
-                        Div(
-                            ChatMessage("assistant", content),
-                            id="chat-container",
-                            hx_swap_oob="beforeend",
-                        ),
-                        Div(id="response-area", hx_swap_oob="true"),
-                        TraceAppend(msg),
-                    ),
-                    event="AgentEvent",
-                )
-                await asyncio.sleep(0.01)
-                yield sse_message(Div(), event="close")
-            else:
-                # Intermediate (tool calls or tool results): append to trace
-                # Also show images/charts in chat if this is a tool result with visuals
-                if is_tool_result(msg):
-                    images = get_images_from_tool_result(msg)
-                    plotly_htmls = get_plotly_htmls_from_tool_result(msg)
-                    if images or plotly_htmls:
-                        chat_visuals = []
-                        if images:
-                            chat_visuals.append(ChatImages(images))
-                        if plotly_htmls:
-                            chat_visuals.append(ChatPlotly(plotly_htmls))
-                        yield sse_message(
-                            Div(
-                                Div(
-                                    *chat_visuals,
-                                    id="chat-container",
-                                    hx_swap_oob="beforeend",
-                                ),
-                                TraceAppend(msg),
-                            ),
-                            event="AgentEvent",
-                        )
-                        await asyncio.sleep(0.01)
-                        continue
-                yield sse_message(TraceAppend(msg), event="AgentEvent")
-                await asyncio.sleep(0.01)
-
-    return EventStream(event_stream())
-
-
-serve()
+        # Events that land close together (e.g. usage + tool call) go out as one frame
+        async for batch in coalesce(run_agent(messages, user_id), keepalive=15):
+            if not batch:
+                yield _PING_FRAME
+                continue
+            yield agent_event(tuple(f for msg in batch for f in stream_fragments(msg, user_id)))
+            if is_final_response(batch[-1]):
+                yield _CLOSE_FRAME
+
+    response = EventStream(event_stream())
+    # Stop reverse proxies (nginx, Cloudflare) from buffering or rewriting the stream
+    response.headers.update({"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"})
+    return response
+
+
+# ============ Server ============
+
+if __name__ == "__main__" and os.getenv("APP_ENV") == "production":
+    # No reloader; uvloop + httptools ship with fasthtml's uvicorn[standard]. Messages and
+    # sandboxes live in process memory, so keep 1 worker unless the proxy pins sessions.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 5001)),
+        workers=int(os.getenv("WEB_CONCURRENCY", 1)),
+        loop="uvloop",
+        http="httptools",
+        log_level="warning",
+    )
+else:
+    serve()
@@ -1,40 +1,64 @@
 """Tests for the agent loop."""
 
-from unittest.mock import MagicMock, patch
+import threading
+import time
+from collections import namedtuple
+from dataclasses import dataclass
+from unittest.mock import patch
 
 from agents.agent import run_agent
+from agents.tools import current_user_id
 
 # Test user ID for all agent tests
 TEST_USER_ID = "test-user-123"
 
 
-def _mock_llm_response(content="Mock response", tool_calls=None, total_tokens=100):
-    """Create a mock litellm completion response."""
-    mock_message = MagicMock()
-    mock_message.content = content
-    mock_message.tool_calls = tool_calls
+@dataclass
+class _FakeMessage:
+    """Stand-in for litellm's Message (plain attributes are much cheaper than MagicMock)."""
+
+    content: str | None = None
+    tool_calls: list | None = None
+    role: str = "assistant"
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
+@dataclass
+class _FakeUsage:
+    total_tokens: int | None = None
+
+
+@dataclass
+class _FakeChoice:
+    message: _FakeMessage
 
-    # Make it behave like a dict for .get() calls
-    mock_message.get = lambda k, d=None: {"role": "assistant", "content": content}.get(k, d)
 
-    mock_choice = MagicMock()
-    mock_choice.message = mock_message
+@dataclass
+class _FakeResponse:
+    choices: list[_FakeChoice]
+    usage: _FakeUsage
 
-    mock_response = MagicMock()
-    mock_response.choices = [mock_choice]
-    # Mock usage with real integer for token count formatting
-    mock_response.usage.total_tokens = total_tokens
 
-    return mock_response
+_FakeFunction = namedtuple("_FakeFunction", "name arguments")
+_FakeToolCall = namedtuple("_FakeToolCall", "id function")
+
+
+def _mock_llm_response(content="Mock response", tool_calls=None, total_tokens=100):
+    """Create a fake litellm completion response."""
+    message = _FakeMessage(content=content, tool_calls=tool_calls)
+    return _FakeResponse(choices=[_FakeChoice(message)], usage=_FakeUsage(total_tokens))
 
 
 def _mock_tool_call(call_id, name, arguments):
-    """Create a mock tool call object."""
-    mock_tc = MagicMock()
-    mock_tc.id = call_id
-    mock_tc.function.name = name
-    mock_tc.function.arguments = arguments
-    return mock_tc
+    """Create a fake tool call object."""
+    return _FakeToolCall(call_id, _FakeFunction(name, arguments))
+
+
+async def _run_agent(messages):
+    """Drive the async agent loop to completion and return every yielded event."""
+    return [event async for event in run_agent(messages, TEST_USER_ID)]
 
 
 def _filter_message_events(events):
@@ -50,24 +74,24 @@ def _filter_usage_events(events):
 class TestRunAgentYieldFormat:
     """Tests for run_agent yield format - should yield standard Chat Completions messages."""
 
-    def test_final_response_yields_assistant_message(self):
+    async def test_final_response_yields_assistant_message(self):
         """Final response should yield a dict with role='assistant' and content."""
-        with patch("agents.agent.litellm.completion") as mock_completion:
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
             mock_completion.return_value = _mock_llm_response("Hello there!")
 
             messages = [{"role": "user", "content": "Hi"}]
-            events = _filter_message_events(list(run_agent(messages, TEST_USER_ID)))
+            events = _filter_message_events(await _run_agent(messages))
 
             assert len(events) == 1
             assert events[0]["role"] == "assistant"
             assert events[0]["content"] == "Hello there!"
             assert "tool_calls" not in events[0]
 
-    def test_tool_call_yields_assistant_message_with_tool_calls(self):
-        """Tool call should yield the assistant message object with tool_calls."""
+    async def test_tool_call_yields_assistant_message_with_tool_calls(self):
+        """Tool call should yield the assistant message as a dict with tool_calls."""
         mock_tc = _mock_tool_call("call_123", "run_code", '{"code": "print(1)"}')
 
-        with patch("agents.agent.litellm.completion") as mock_completion:
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
             with patch("agents.agent.TOOL_FUNCTIONS", {"run_code": lambda **kwargs: "1"}):
                 mock_completion.side_effect = [
                     _mock_llm_response(content=None, tool_calls=[mock_tc]),
@@ -75,16 +99,20 @@ class TestRunAgentYieldFormat:
                 ]
 
                 messages = [{"role": "user", "content": "Run some code"}]
-                events = _filter_message_events(list(run_agent(messages, TEST_USER_ID)))
+                events = _filter_message_events(await _run_agent(messages))
 
                 # Should yield: assistant with tool_calls, tool result, final assistant
                 assert len(events) == 3
 
-                # First: assistant message with tool_calls
-                assert hasattr(events[0], "tool_calls") or events[0].get("tool_calls")
-                tool_calls = getattr(events[0], "tool_calls", None) or events[0].get("tool_calls")
-                assert tool_calls is not None
-                assert len(tool_calls) == 1
+                # First: assistant message with tool_calls, as a plain dict
+                assert events[0]["role"] == "assistant"
+                assert events[0]["tool_calls"] == [
+                    {"id": "call_123", "type": "function", "function": {"name": "run_code", "arguments": '{"code": "print(1)"}'}}
+                ]
+
+                # History keeps the original LLM message object
+                assert not isinstance(messages[1], dict)
+                assert messages[1].tool_calls == [mock_tc]
 
                 # Second: tool result message
                 assert events[1]["role"] == "tool"
@@ -95,12 +123,12 @@ class TestRunAgentYieldFormat:
                 assert events[2]["role"] == "assistant"
                 assert events[2]["content"] == "Done!"
 
-    def test_multiple_tool_calls_yield_multiple_tool_results(self):
+    async def test_multiple_tool_calls_yield_multiple_tool_results(self):
         """Multiple parallel tool calls should yield multiple tool result messages."""
         mock_tc1 = _mock_tool_call("call_1", "run_code", '{"code": "1+1"}')
         mock_tc2 = _mock_tool_call("call_2", "run_code", '{"code": "2+2"}')
 
-        with patch("agents.agent.litellm.completion") as mock_completion:
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
             with patch("agents.agent.TOOL_FUNCTIONS", {"run_code": lambda **kwargs: "result"}):
                 mock_completion.side_effect = [
                     _mock_llm_response(content=None, tool_calls=[mock_tc1, mock_tc2]),
@@ -108,7 +136,7 @@ class TestRunAgentYieldFormat:
                 ]
 
                 messages = [{"role": "user", "content": "Run two things"}]
-                events = _filter_message_events(list(run_agent(messages, TEST_USER_ID)))
+                events = _filter_message_events(await _run_agent(messages))
 
                 # Should yield: assistant with tool_calls, tool result 1, tool result 2, final
                 assert len(events) == 4
@@ -127,9 +155,9 @@ class TestRunAgentYieldFormat:
                 assert events[3]["role"] == "assistant"
                 assert events[3]["content"] == "All done!"
 
-    def test_messages_list_updated_with_same_format(self):
+    async def test_messages_list_updated_with_same_format(self):
         """Messages list should contain the same objects that were yielded."""
-        with patch("agents.agent.litellm.completion") as mock_completion:
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
             mock_completion.return_value = _mock_llm_response("Hello!")
 
             # System prompt is added by main.py before calling run_agent
@@ -137,7 +165,7 @@ class TestRunAgentYieldFormat:
                 {"role": "system", "content": "System prompt"},
                 {"role": "user", "content": "Hi"},
             ]
-            events = _filter_message_events(list(run_agent(messages, TEST_USER_ID)))
+            events = _filter_message_events(await _run_agent(messages))
 
             # Messages should have: system, user, assistant
             assert len(messages) == 3
@@ -153,7 +181,7 @@ class TestRunAgentYieldFormat:
 class TestRunAgentContentFiltering:
     """Tests for content block filtering (UI vs LLM)."""
 
-    def test_plotly_html_filtered_from_llm_messages(self):
+    async def test_plotly_html_filtered_from_llm_messages(self):
         """plotly_html should be in yielded message but filtered from LLM messages."""
         mock_tc = _mock_tool_call("call_123", "run_code", '{"code": "make chart"}')
 
@@ -164,7 +192,7 @@ class TestRunAgentContentFiltering:
             {"type": "plotly_html", "html": "<div>interactive chart</div>"},
         ]
 
-        with patch("agents.agent.litellm.completion") as mock_completion:
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
             with patch("agents.agent.TOOL_FUNCTIONS", {"run_code": lambda **kwargs: tool_result}):
                 mock_completion.side_effect = [
                     _mock_llm_response(content=None, tool_calls=[mock_tc]),
@@ -172,7 +200,7 @@ class TestRunAgentContentFiltering:
                 ]
 
                 messages = [{"role": "user", "content": "Make a chart"}]
-                events = _filter_message_events(list(run_agent(messages, TEST_USER_ID)))
+                events = _filter_message_events(await _run_agent(messages))
 
                 # Yielded tool message should have full content (for UI)
                 tool_event = events[1]
@@ -188,12 +216,116 @@ class TestRunAgentContentFiltering:
                 assert any(c.get("type") == "image_url" for c in tool_msg_in_messages["content"])
 
 
+class TestRunAgentToolExecution:
+    """Tests for running tools on the tool executor."""
+
+    async def test_tool_sees_current_user_id(self):
+        """Tools run on a pool thread but must still see the user's context."""
+        mock_tc = _mock_tool_call("call_123", "run_code", '{"code": "print(1)"}')
+        seen = []
+
+        def fake_run_code(**kwargs):
+            seen.append(current_user_id.get())
+            return "1"
+
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
+            with patch("agents.agent.TOOL_FUNCTIONS", {"run_code": fake_run_code}):
+                mock_completion.side_effect = [
+                    _mock_llm_response(content=None, tool_calls=[mock_tc]),
+                    _mock_llm_response("Done!"),
+                ]
+
+                await _run_agent([{"role": "user", "content": "Run some code"}])
+
+                assert seen == [TEST_USER_ID]
+
+    async def test_parallel_tool_calls_run_concurrently(self):
+        """With the limit off, tool calls from one turn should overlap, with results still in call order."""
+        mock_tc1 = _mock_tool_call("call_1", "run_code", '{"code": "first"}')
+        mock_tc2 = _mock_tool_call("call_2", "run_code", '{"code": "second"}')
+
+        # Each call waits here for the other, so both must be running at the same time
+        # (a timeout breaks the barrier, and the error would end up as the tool content)
+        both_running = threading.Barrier(2, timeout=5)
+
+        def fake_run_code(code):
+            both_running.wait()
+            return code
+
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
+            with (
+                patch("agents.agent.TOOL_FUNCTIONS", {"run_code": fake_run_code}),
+                patch("agents.agent.TOOL_CONCURRENCY_LIMIT", 0),
+            ):
+                mock_completion.side_effect = [
+                    _mock_llm_response(content=None, tool_calls=[mock_tc1, mock_tc2]),
+                    _mock_llm_response("Done!"),
+                ]
+
+                events = _filter_message_events(await _run_agent([{"role": "user", "content": "Go"}]))
+
+                assert [(e["tool_call_id"], e["content"]) for e in events[1:3]] == [("call_1", "first"), ("call_2", "second")]
+
+    async def test_tool_calls_run_one_at_a_time_in_call_order_by_default(self):
+        """Calls share one sandbox interpreter, so by default each runs after the previous one."""
+        calls = [_mock_tool_call(f"call_{i}", "run_code", f'{{"code": "{i}"}}') for i in range(3)]
+        running = 0
+        peak = 0
+        order = []
+
+        def fake_run_code(code):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            order.append(code)
+            time.sleep(0.02)
+            running -= 1
+            return "ok"
+
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
+            with patch("agents.agent.TOOL_FUNCTIONS", {"run_code": fake_run_code}):
+                mock_completion.side_effect = [
+                    _mock_llm_response(content=None, tool_calls=calls),
+                    _mock_llm_response("Done!"),
+                ]
+
+                await _run_agent([{"role": "user", "content": "Go"}])
+
+                assert peak == 1
+                assert order == ["0", "1", "2"]
+
+    async def test_tool_errors_become_tool_content(self):
+        """A failing call or bad arguments shouldn't stop the other calls or the loop."""
+        mock_tc1 = _mock_tool_call("call_1", "run_code", '{"code": "boom"}')
+        mock_tc2 = _mock_tool_call("call_2", "run_code", "{not json")
+        mock_tc3 = _mock_tool_call("call_3", "run_code", '{"code": "fine"}')
+
+        def fake_run_code(code):
+            if code == "boom":
+                raise RuntimeError("sandbox exploded")
+            return "ok"
+
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
+            with patch("agents.agent.TOOL_FUNCTIONS", {"run_code": fake_run_code}):
+                mock_completion.side_effect = [
+                    _mock_llm_response(content=None, tool_calls=[mock_tc1, mock_tc2, mock_tc3]),
+                    _mock_llm_response("Done!"),
+                ]
+
+                events = _filter_message_events(await _run_agent([{"role": "user", "content": "Go"}]))
+
+                assert "RuntimeError: sandbox exploded" in events[1]["content"]
+                assert "JSONDecodeError" in events[2]["content"]
+                assert events[3]["content"] == "ok"
+                assert events[4]["content"] == "Done!"
+
+
 class TestRunAgentMessageHistory:
     """Tests for message history management."""
 
-    def test_works_with_system_prompt_from_caller(self):
+    async def test_works_with_system_prompt_from_caller(self):
         """run_agent expects system prompt to already be present (added by main.py)."""
-        with patch("agents.agent.litellm.completion") as mock_completion:
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
             mock_completion.return_value = _mock_llm_response("Hi")
 
             # System prompt is added by send_message() in main.py before calling run_agent
@@ -201,22 +333,22 @@ class TestRunAgentMessageHistory:
                 {"role": "system", "content": "Test system prompt"},
                 {"role": "user", "content": "Hello"},
             ]
-            list(run_agent(messages, TEST_USER_ID))
+            await _run_agent(messages)
 
             # System prompt should remain unchanged
             assert messages[0]["role"] == "system"
             assert messages[0]["content"] == "Test system prompt"
 
-    def test_preserves_existing_system_prompt(self):
+    async def test_preserves_existing_system_prompt(self):
         """Should not add system prompt if already present."""
-        with patch("agents.agent.litellm.completion") as mock_completion:
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
             mock_completion.return_value = _mock_llm_response("Hi")
 
             messages = [
                 {"role": "system", "content": "Custom system prompt"},
                 {"role": "user", "content": "Hello"},
             ]
-            list(run_agent(messages, TEST_USER_ID))
+            await _run_agent(messages)
 
             assert messages[0]["role"] == "system"
             assert messages[0]["content"] == "Custom system prompt"
@@ -226,24 +358,24 @@ class TestRunAgentMessageHistory:
 class TestRunAgentUsageTracking:
     """Tests for token usage tracking."""
 
-    def test_yields_usage_event_with_correct_structure(self):
+    async def test_yields_usage_event_with_correct_structure(self):
         """Usage events should have type='usage' and a 'total' field."""
-        with patch("agents.agent.litellm.completion") as mock_completion:
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
             mock_completion.return_value = _mock_llm_response("Hi", total_tokens=150)
 
             messages = [{"role": "user", "content": "Hello"}]
-            events = list(run_agent(messages, TEST_USER_ID))
+            events = await _run_agent(messages)
             usage_events = _filter_usage_events(events)
 
             assert len(usage_events) == 1
             assert usage_events[0]["type"] == "usage"
             assert usage_events[0]["total"] == 150
 
-    def test_usage_yielded_after_each_llm_call(self):
+    async def test_usage_yielded_after_each_llm_call(self):
         """Each LLM call should yield a usage event."""
         mock_tc = _mock_tool_call("call_1", "run_code", '{"code": "1"}')
 
-        with patch("agents.agent.litellm.completion") as mock_completion:
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
             with patch("agents.agent.TOOL_FUNCTIONS", {"run_code": lambda **kwargs: "1"}):
                 mock_completion.side_effect = [
                     _mock_llm_response(content=None, tool_calls=[mock_tc], total_tokens=50),
@@ -251,17 +383,17 @@ class TestRunAgentUsageTracking:
                 ]
 
                 messages = [{"role": "user", "content": "Run code"}]
-                events = list(run_agent(messages, TEST_USER_ID))
+                events = await _run_agent(messages)
                 usage_events = _filter_usage_events(events)
 
                 # Should have 2 usage events (one per LLM call)
                 assert len(usage_events) == 2
 
-    def test_usage_accumulates_across_tool_calls(self):
+    async def test_usage_accumulates_across_tool_calls(self):
         """Token usage should accumulate across multiple LLM calls."""
         mock_tc = _mock_tool_call("call_1", "run_code", '{"code": "1"}')
 
-        with patch("agents.agent.litellm.completion") as mock_completion:
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
             with patch("agents.agent.TOOL_FUNCTIONS", {"run_code": lambda **kwargs: "1"}):
                 mock_completion.side_effect = [
                     _mock_llm_response(content=None, tool_calls=[mock_tc], total_tokens=100),
@@ -269,7 +401,7 @@ class TestRunAgentUsageTracking:
                 ]
 
                 messages = [{"role": "user", "content": "Run code"}]
-                events = list(run_agent(messages, TEST_USER_ID))
+                events = await _run_agent(messages)
                 usage_events = _filter_usage_events(events)
 
                 # First usage: 100 tokens
@@ -277,12 +409,12 @@ class TestRunAgentUsageTracking:
                 # Second usage: 100 + 50 = 150 tokens (cumulative)
                 assert usage_events[1]["total"] == 150
 
-    def test_usage_accumulates_across_multiple_tool_loops(self):
+    async def test_usage_accumulates_across_multiple_tool_loops(self):
         """Token usage should accumulate across multiple tool call loops."""
         mock_tc1 = _mock_tool_call("call_1", "run_code", '{"code": "1"}')
         mock_tc2 = _mock_tool_call("call_2", "run_code", '{"code": "2"}')
 
-        with patch("agents.agent.litellm.completion") as mock_completion:
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
             with patch("agents.agent.TOOL_FUNCTIONS", {"run_code": lambda **kwargs: "result"}):
                 mock_completion.side_effect = [
                     _mock_llm_response(content=None, tool_calls=[mock_tc1], total_tokens=100),
@@ -291,7 +423,7 @@ class TestRunAgentUsageTracking:
                 ]
 
                 messages = [{"role": "user", "content": "Run code"}]
-                events = list(run_agent(messages, TEST_USER_ID))
+                events = await _run_agent(messages)
                 usage_events = _filter_usage_events(events)
 
                 # Should have 3 usage events
@@ -301,14 +433,14 @@ class TestRunAgentUsageTracking:
                 assert usage_events[1]["total"] == 180
                 assert usage_events[2]["total"] == 240
 
-    def test_usage_handles_none_total_tokens(self):
+    async def test_usage_handles_none_total_tokens(self):
         """Usage tracking should handle None total_tokens gracefully."""
-        with patch("agents.agent.litellm.completion") as mock_completion:
+        with patch("agents.agent.litellm.acompletion") as mock_completion:
             mock_response = _mock_llm_response("Hi", total_tokens=None)
             mock_completion.return_value = mock_response
 
             messages = [{"role": "user", "content": "Hello"}]
-            events = list(run_agent(messages, TEST_USER_ID))
+            events = await _run_agent(messages)
             usage_events = _filter_usage_events(events)
 
             # Should still yield a usage event with 0 total
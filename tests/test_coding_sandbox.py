@@ -1,4 +1,7 @@
+import json
+import threading
 import time
+from contextlib import contextmanager
 from io import StringIO
 from textwrap import dedent
 from unittest.mock import MagicMock, patch
@@ -7,7 +10,39 @@ from uuid import uuid4
 import modal
 import pytest
 
+from agents.coding_sandbox import SANDBOX_IDLE_TIMEOUT, SANDBOX_TIMEOUT
 from agents.coding_sandbox import ModalSandbox as Sandbox
+from agents.coding_sandbox import _get_app
+
+
+def wait_until(condition, timeout: float, interval: float = 0.5) -> None:
+    """Poll `condition` until it returns True, failing after `timeout` seconds."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return
+        time.sleep(interval)
+    raise TimeoutError(f"condition not met within {timeout}s")
+
+
+@pytest.fixture(scope="session")
+def shared_sandbox():
+    """One warm default sandbox shared by the real-Modal tests that don't need a fresh one.
+
+    Sandbox startup dominates these tests. Tests that pass a one-off init_script or
+    timeouts, or check termination, still create their own.
+    """
+    sb = Sandbox()
+    yield sb
+    sb.terminate()
+
+
+@pytest.fixture(scope="session")
+def xyz_sandbox():
+    """A sandbox started with a fixed init_script, for tests that only read its variables."""
+    sb = Sandbox(init_script="x=1\ny=2\nz=3")
+    yield sb
+    sb.terminate()
 
 
 @pytest.mark.slow
@@ -19,10 +54,13 @@ class TestRealModalSandbox:
 
     For unit tests that can run in the CI, see TestMockedModalSandbox below, which
     mocks the Modal sandbox to avoid launching real sandboxes.
+
+    The tests are independent and mostly wait on Modal, so run them in parallel with
+    pytest-xdist: `./dev test -m slow -n 8` (each worker gets its own shared_sandbox).
     """
 
-    def test_code_sandbox_test1(self):
-        sb = Sandbox()
+    def test_code_sandbox_test1(self, shared_sandbox):
+        sb = shared_sandbox
         resp = sb.run_code('print("Hello, World!")')
         assert resp == {
             "stdout": "Hello, World!\n",
@@ -36,7 +74,6 @@ class TestRealModalSandbox:
         assert resp == {"stdout": "2\n", "stderr": "", "images": [], "plotly_htmls": []}
         resp = sb.run_code("z = y ** 2\nprint(z)")
         assert resp == {"stdout": "4\n", "stderr": "", "images": [], "plotly_htmls": []}
-        sb.terminate()
 
     def test_code_sandbox_test2(self):
         sb = Sandbox(init_script="print('INIT1')\nprint('INIT2')\nprint('INIT3')\nz=3.14")
@@ -49,27 +86,14 @@ class TestRealModalSandbox:
         }
         sb.terminate()
 
-    def test_code_sandbox_test3(self):
-        sb = Sandbox(init_script="x=1\ny=2\nz=3")
-        resp = sb.run_code("print(x, y, z)")
-        assert resp == {
-            "stdout": "1 2 3\n",
-            "stderr": "",
-            "images": [],
-            "plotly_htmls": [],
-        }
-        sb.terminate()
-
-    def test_code_sandbox_test4(self):
-        sb = Sandbox(init_script="x=1\ny=2\nz=3")
-        resp = sb.run_code("print(x, y, z)")
+    def test_code_sandbox_test3(self, xyz_sandbox):
+        resp = xyz_sandbox.run_code("print(x, y, z)")
         assert resp == {
             "stdout": "1 2 3\n",
             "stderr": "",
             "images": [],
             "plotly_htmls": [],
         }
-        sb.terminate()
 
     def test_code_sandbox_test5(self):
         # Create a sandbox with initialization code that defines helper functions and variables
@@ -155,9 +179,9 @@ class TestRealModalSandbox:
 
         sb.terminate()
 
-    def test_get_running_sandbox_from_id(self):
+    def test_get_running_sandbox_from_id(self, shared_sandbox):
         assert Sandbox._get_running_sandbox_from_id(uuid4()) is None
-        sb = Sandbox()
+        sb = shared_sandbox
         sb.run_code("x=2")
         sb.run_code("y=4")
         sb = Sandbox(sandbox_id=sb.sandbox_id)
@@ -168,10 +192,9 @@ class TestRealModalSandbox:
             "images": [],
             "plotly_htmls": [],
         }
-        sb.terminate()
 
-    def test_slow_command(self):
-        sb = Sandbox()
+    def test_slow_command(self, shared_sandbox):
+        sb = shared_sandbox
         slow_command = dedent(
             """
         import time
@@ -181,11 +204,10 @@ class TestRealModalSandbox:
         )
         res = sb.run_code(slow_command)
         assert res["stdout"] == "Hello, world!\n"
-        sb.terminate()
 
-    def test_matplotlib_plot_returns_image(self):
+    def test_matplotlib_plot_returns_image(self, shared_sandbox):
         """Test that matplotlib plots are captured and returned as base64 images."""
-        sb = Sandbox()
+        sb = shared_sandbox
         plot_code = dedent(
             """
         import matplotlib
@@ -212,11 +234,10 @@ class TestRealModalSandbox:
         decoded = base64.b64decode(res["images"][0])
         # PNG files start with these magic bytes
         assert decoded[:8] == b"\x89PNG\r\n\x1a\n"
-        sb.terminate()
 
-    def test_multiple_matplotlib_plots_returns_multiple_images(self):
+    def test_multiple_matplotlib_plots_returns_multiple_images(self, shared_sandbox):
         """Test that multiple matplotlib figures are all captured."""
-        sb = Sandbox()
+        sb = shared_sandbox
         plot_code = dedent(
             """
         import matplotlib
@@ -239,7 +260,6 @@ class TestRealModalSandbox:
         res = sb.run_code(plot_code)
         assert res["stdout"] == "Two plots created\n"
         assert len(res["images"]) == 2
-        sb.terminate()
 
     def test_timeout_kills_sandbox_despite_activity(self):
         """Test that overall timeout expires even when run_code is called regularly."""
@@ -256,7 +276,8 @@ class TestRealModalSandbox:
         sb = Sandbox(timeout=30, idle_timeout=3)
 
         sb.run_code("print('first command')")
-        time.sleep(5)  # wait longer than idle_timeout
+        # poll() doesn't count as activity, so this returns as soon as Modal kills it
+        wait_until(lambda: sb.sandbox.poll() is not None, timeout=15)
 
         with pytest.raises(Exception):
             sb.run_code("print('should fail')")
@@ -321,63 +342,119 @@ class TestMockedModalSandbox:
             mock_sb = MagicMock(object_id="test-sandbox-id")
             mock_sandbox_create.return_value = mock_sb
 
+            _get_app.cache_clear()  # Don't hand out an app cached from another test
             yield mock_sb
+            _get_app.cache_clear()
 
-    def test_open_sandbox_file_retries_on_filesystem_execution_error(self, mock_sandbox):
+    @pytest.fixture
+    def bare_sb(self):
+        """A ModalSandbox around a mocked Modal sandbox, skipping __init__ (no app lookup or create)."""
+        sb = Sandbox.__new__(Sandbox)
+        sb.sandbox = MagicMock(object_id="test-sandbox-id")
+        sb._run_lock = threading.Lock()
+        return sb
+
+    def test_run_code_holds_the_sandbox_lock(self, bare_sb):
+        # Concurrent calls would share the STDIN/output file exchange, so the whole exchange is locked
+        held = []
+
+        @contextmanager
+        def fake_open(file_path, mode, **kwargs):
+            held.append(bare_sb._run_lock.locked())
+            yield StringIO(json.dumps({"stdout": "1\n"})) if mode == "r" else StringIO()
+
+        bare_sb._open_sandbox_file = fake_open
+
+        assert bare_sb.run_code("print(1)") == {"stdout": "1\n"}
+        assert held == [True, True]
+        assert not bare_sb._run_lock.locked()
+
+    def test_timeouts_are_passed_to_modal(self, mock_sandbox):
+        # Modal enforces timeout/idle_timeout server-side; this is the client's whole part in it
+        Sandbox(timeout=10, idle_timeout=3)
+        kwargs = modal.Sandbox.create.call_args.kwargs
+        assert kwargs["timeout"] == 10
+        assert kwargs["idle_timeout"] == 3
+
+    def test_timeouts_default_to_module_settings(self, mock_sandbox):
+        Sandbox()
+        kwargs = modal.Sandbox.create.call_args.kwargs
+        assert kwargs["timeout"] == SANDBOX_TIMEOUT
+        assert kwargs["idle_timeout"] == SANDBOX_IDLE_TIMEOUT
+
+    def test_app_lookup_is_cached(self, mock_sandbox):
+        Sandbox()
+        Sandbox()
+        modal.App.lookup.assert_called_once_with("python-sandbox", create_if_missing=True)
+
+    def test_open_sandbox_file_retries_on_filesystem_execution_error(self, bare_sb):
         code_snippet = "x=1"
         mock_file = StringIO(code_snippet)
 
-        mock_sandbox.open.side_effect = [
+        bare_sb.sandbox.open.side_effect = [
             modal.exception.FilesystemExecutionError(),
             modal.exception.FilesystemExecutionError(),
             modal.exception.FilesystemExecutionError(),
             mock_file,
         ]
 
-        sb = Sandbox()
-
-        with sb._open_sandbox_file("/test/file.txt", "r", max_attempts=10) as f:
+        with bare_sb._open_sandbox_file("/test/file.txt", "r", max_attempts=10) as f:
             content = f.read()
             assert content == code_snippet
 
-        assert mock_sandbox.open.call_count == 4
+        assert bare_sb.sandbox.open.call_count == 4
+
+    def test_open_sandbox_file_backs_off_on_filesystem_execution_error(self, bare_sb, mock_time_sleep):
+        bare_sb.sandbox.open.side_effect = [modal.exception.FilesystemExecutionError()] * 6 + [StringIO()]
+
+        with bare_sb._open_sandbox_file("/test/file.txt", "r", max_attempts=10, retry_delay=0.1):
+            pass
+
+        delays = [c.args[0] for c in mock_time_sleep.call_args_list]
+        assert len(delays) == 6
+        assert delays == sorted(delays)
+        # Doubling from 0.1s, capped at 2s, plus up to 0.05s of jitter
+        for delay, base in zip(delays, [0.1, 0.2, 0.4, 0.8, 1.6, 2.0]):
+            assert base <= delay <= base + 0.05
 
-    def test_open_sandbox_file_raises_exception_on_max_attempts_reached(self, mock_sandbox):
-        mock_sandbox.open.side_effect = modal.exception.FilesystemExecutionError()
+    def test_open_sandbox_file_polls_extra_exceptions_at_fixed_delay(self, bare_sb, mock_time_sleep):
+        bare_sb.sandbox.open.side_effect = [FileNotFoundError()] * 5 + [StringIO()]
 
-        sb = Sandbox()
+        with bare_sb._open_sandbox_file("/test/file.txt", "r", max_attempts=10, retry_delay=0.1, extra_exceptions=(FileNotFoundError,)):
+            pass
+
+        assert [c.args[0] for c in mock_time_sleep.call_args_list] == [0.1] * 5
+
+    def test_open_sandbox_file_raises_exception_on_max_attempts_reached(self, bare_sb):
+        bare_sb.sandbox.open.side_effect = modal.exception.FilesystemExecutionError()
 
         with pytest.raises(modal.exception.FilesystemExecutionError):
-            with sb._open_sandbox_file("/test/file.txt", "r", max_attempts=1) as _f:
+            with bare_sb._open_sandbox_file("/test/file.txt", "r", max_attempts=1) as _f:
                 pass
 
-        assert mock_sandbox.open.call_count == 1
+        assert bare_sb.sandbox.open.call_count == 1
 
-    def test_open_sandbox_file_accepts_extra_exceptions(self, mock_sandbox):
+    def test_open_sandbox_file_accepts_extra_exceptions(self, bare_sb):
         code_snippet = "x=1"
         mock_file = StringIO(code_snippet)
 
-        mock_sandbox.open.side_effect = [
+        bare_sb.sandbox.open.side_effect = [
             modal.exception.FilesystemExecutionError(),
             FileNotFoundError(),
             mock_file,
         ]
 
-        sb = Sandbox()
-
-        with sb._open_sandbox_file("/test/file.txt", "r", max_attempts=10, extra_exceptions=(FileNotFoundError,)) as f:
+        with bare_sb._open_sandbox_file("/test/file.txt", "r", max_attempts=10, extra_exceptions=(FileNotFoundError,)) as f:
             content = f.read()
             assert content == code_snippet
 
-        assert mock_sandbox.open.call_count == 3
-
-    def test_open_sandbox_file_raises_unexpected_exception(self, mock_sandbox):
-        mock_sandbox.open.side_effect = ValueError()
+        assert bare_sb.sandbox.open.call_count == 3
 
-        sb = Sandbox()
+    def test_open_sandbox_file_raises_unexpected_exception(self, bare_sb):
+        bare_sb.sandbox.open.side_effect = ValueError()
 
         with pytest.raises(ValueError):
-            with sb._open_sandbox_file("/test/file.txt", "r", max_attempts=10) as _f:
+            with bare_sb._open_sandbox_file("/test/file.txt", "r", max_attempts=10) as _f:
                 pass
 
-        assert mock_sandbox.open.call_count == 1
+        assert bare_sb.sandbox.open.call_count == 1
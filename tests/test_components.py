@@ -1,5 +1,8 @@
 """Tests for UI components."""
 
+import re
+
+import pytest
 from fasthtml.common import to_xml
 from agents.ui.components import (
     ChatMessage,
@@ -8,12 +11,24 @@ from agents.ui.components import (
     ChatInput,
     ThinkingIndicator,
     TraceUpdate,
+    ChatImages,
+    ChatPlotly,
+    get_images_from_tool_result,
+    get_plotly_htmls_from_tool_result,
+    clear_trace_cache,
+    user_traces,
 )
 
 
 def render(component):
-    """Helper to render a FastHTML component to string."""
-    return to_xml(component)
+    """Helper to render a FastHTML component to string (compact; tests only search it)."""
+    return to_xml(component, indent=False)
+
+
+def assert_contains_all(html, needles):
+    """Assert every substring is in html, reporting all the missing ones at once."""
+    missing = [n for n in needles if n not in html]
+    assert not missing, f"missing from html: {missing}"
 
 
 class TestChatMessage:
@@ -45,29 +60,29 @@ class TestChatMessage:
 class TestTraceMessage:
     """Tests for TraceMessage component."""
 
-    def test_system_message_badge(self):
-        msg = {"role": "system", "content": "You are helpful"}
-        html = render(TraceMessage(msg))
-        assert "SYSTEM" in html
-        assert "badge-warning" in html
-
-    def test_user_message_badge(self):
-        msg = {"role": "user", "content": "Hello"}
-        html = render(TraceMessage(msg))
-        assert "USER" in html
-        assert "badge-primary" in html
-
-    def test_assistant_message_badge(self):
-        msg = {"role": "assistant", "content": "Hi"}
-        html = render(TraceMessage(msg))
-        assert "ASSISTANT" in html
-        assert "badge-secondary" in html
-
-    def test_tool_message_badge(self):
+    @pytest.mark.parametrize(
+        "role,label,badge",
+        [
+            ("system", "SYSTEM", "badge-warning"),
+            ("user", "USER", "badge-primary"),
+            ("assistant", "ASSISTANT", "badge-secondary"),
+            ("tool", "TOOL", "badge-accent"),
+            ("custom", "CUSTOM", "badge-ghost"),
+        ],
+    )
+    def test_role_badge(self, role, label, badge):
+        html = render(TraceMessage({"role": role, "content": "Hello"}))
+        assert label in html
+        assert badge in html
+
+    def test_system_message_render_is_cached(self):
+        """The constant system prompt should be rendered once and reused."""
+        msg = {"role": "system", "content": "Cached prompt"}
+        assert TraceMessage(msg) is TraceMessage(dict(msg))
+
+    def test_tool_message_shows_tool_call_id(self):
         msg = {"role": "tool", "tool_call_id": "123", "content": "result"}
         html = render(TraceMessage(msg))
-        assert "TOOL" in html
-        assert "badge-accent" in html
         assert "tool_call_id: 123" in html
 
     def test_tool_message_with_image_content_blocks(self):
@@ -77,14 +92,13 @@ class TestTraceMessage:
             "tool_call_id": "call_456",
             "content": [
                 {"type": "text", "text": "Plot created"},
-                {"type": "image_url", "image_url": "data:image/png;base64,ABC123"},
+                {"type": "image_url", "image_url": "data:image/png;base64,ABC123=="},
             ],
         }
         html = render(TraceMessage(msg))
-        assert "TOOL" in html
-        assert "Plot created" in html
-        assert "<img" in html
-        assert "data:image/png;base64,ABC123" in html
+        # The data URI is served from /img/{key} rather than inlined
+        assert_contains_all(html, ("TOOL", "Plot created", "<img", 'src="/img/'))
+        assert "data:image/png;base64,ABC123==" not in html
 
     def test_tool_message_with_text_only_content_blocks(self):
         """Tool results with only text content blocks should render text."""
@@ -113,8 +127,7 @@ class TestTraceMessage:
         html = render(TraceMessage(msg))
         # Each image has a thumbnail and a modal image (2 images * 2 = 4 img tags)
         assert html.count("<img") == 4
-        assert "IMG1" in html
-        assert "IMG2" in html
+        assert len(set(re.findall(r'src="(/img/[^"]+)"', str(html)))) == 2
 
     def test_tool_message_with_plotly_html(self):
         """Tool results with plotly_html content blocks should render iframes."""
@@ -181,31 +194,70 @@ class TestTraceView:
 
     def test_renders_all_messages(self, sample_messages):
         html = render(TraceView(sample_messages))
-        assert "SYSTEM" in html
-        assert "USER" in html
-        assert "ASSISTANT" in html
+        assert_contains_all(html, ("SYSTEM", "USER", "ASSISTANT"))
 
     def test_none_messages_shows_placeholder(self):
         html = render(TraceView(None))
         assert "No messages yet" in html
 
 
-class TestChatInput:
-    """Tests for ChatInput component."""
+class TestTraceCache:
+    """Tests for the per-user cache of rendered trace messages."""
 
-    def test_has_textarea(self):
-        html = render(ChatInput())
-        assert "<textarea" in html
-        assert 'name="message"' in html
+    @pytest.fixture(autouse=True)
+    def empty_cache(self):
+        user_traces.clear()
+        yield
+        user_traces.clear()
 
-    def test_has_send_button(self):
-        html = render(ChatInput())
-        assert "Send" in html
-        assert "btn-primary" in html
+    def test_same_message_object_is_rendered_once(self):
+        """Re-rendering a message already in the history should reuse its HTML."""
+        msg = {"role": "user", "content": "Hello"}
+        TraceView([msg], "user-1")
+        first = user_traces["user-1"][id(msg)]
+        TraceView([msg], "user-1")
+        assert user_traces["user-1"][id(msg)] is first
+
+    def test_different_messages_render_separately(self):
+        """The cache is keyed on the message object, not its contents."""
+        first = {"role": "user", "content": "Hello"}
+        second = {"role": "user", "content": "Goodbye"}
+        TraceView([first], "user-1")
+        assert "Goodbye" in render(TraceView([second], "user-1"))
+
+    def test_keeps_only_messages_still_in_the_history(self):
+        """Trimmed messages are released on the next render."""
+        old = {"role": "user", "content": "Old"}
+        new = {"role": "user", "content": "New"}
+        TraceView([old, new], "user-1")
+        TraceView([new], "user-1")
+        assert list(user_traces["user-1"]) == [id(new)]
+
+    def test_without_user_nothing_is_cached(self):
+        TraceView([{"role": "user", "content": "Hello"}])
+        assert len(user_traces) == 0
+
+    def test_clear_drops_the_users_entries(self):
+        TraceView([{"role": "user", "content": "Hello"}], "user-1")
+        clear_trace_cache("user-1")
+        assert "user-1" not in user_traces
 
-    def test_has_htmx_attributes(self):
-        html = render(ChatInput())
-        assert 'hx-post="/chat"' in html
+
+class TestChatInput:
+    """Tests for ChatInput component."""
+
+    @pytest.mark.parametrize(
+        "needle",
+        [
+            "<textarea",  # Message textarea
+            'name="message"',
+            "Send",  # Send button
+            "btn-primary",
+            'hx-post="/chat"',  # HTMX attributes
+        ],
+    )
+    def test_renders(self, needle):
+        assert needle in render(ChatInput())
 
     def test_has_keyboard_shortcut_trigger(self):
         html = render(ChatInput())
@@ -234,3 +286,93 @@ class TestTraceUpdate:
     def test_has_trace_container_id(self, sample_messages):
         html = render(TraceUpdate(sample_messages))
         assert 'id="trace-container"' in html
+
+
+class TestImageHelpers:
+    """Tests for image extraction and rendering helpers."""
+
+    def test_get_images_from_tool_result_extracts_urls(self):
+        """get_images_from_tool_result should extract image URLs from content blocks."""
+        msg = {
+            "role": "tool",
+            "content": [
+                {"type": "text", "text": "Plot created"},
+                {"type": "image_url", "image_url": "data:image/png;base64,ABC123"},
+                {"type": "image_url", "image_url": "data:image/png;base64,DEF456"},
+            ],
+        }
+        images = get_images_from_tool_result(msg)
+        assert len(images) == 2
+        assert "ABC123" in images[0]
+        assert "DEF456" in images[1]
+
+    @pytest.mark.parametrize("content", ["Just a string result", [{"type": "text", "text": "No images here"}]])
+    def test_get_images_from_tool_result_returns_empty_without_images(self, content):
+        """get_images_from_tool_result should return an empty list for string content or no image blocks."""
+        assert get_images_from_tool_result({"role": "tool", "content": content}) == []
+
+    @pytest.mark.parametrize("urls", [[], None])
+    def test_chat_images_returns_none_without_images(self, urls):
+        """ChatImages should return None for an empty list or None."""
+        assert ChatImages(urls) is None
+
+    def test_chat_images_renders_images(self):
+        """ChatImages should render img tags for provided URLs."""
+        result = ChatImages(["data:image/png;base64,IMG1", "data:image/png;base64,IMG2"])
+        html = to_xml(result)
+        # Each image has a thumbnail and a modal image (2 images * 2 = 4 img tags)
+        assert html.count("<img") == 4
+        assert len(set(re.findall(r'src="(/img/[^"]+)"', html))) == 2
+        assert "chat-start" in html
+
+    def test_chat_images_modal_ids_are_stable_and_distinct(self):
+        """Each image gets its own modal id, and the id doesn't change between renders."""
+        urls = [f"data:image/png;base64,IMG{i}" for i in range(50)]
+        ids = re.findall(r'<dialog id="([^"]+)"', to_xml(ChatImages(urls)))
+        assert len(set(ids)) == 50
+        assert ids == re.findall(r'<dialog id="([^"]+)"', to_xml(ChatImages(urls)))
+
+
+class TestPlotlyHelpers:
+    """Tests for Plotly extraction and rendering helpers."""
+
+    def test_get_plotly_htmls_from_tool_result_extracts_html(self):
+        """get_plotly_htmls_from_tool_result should extract HTML from content blocks."""
+        msg = {
+            "role": "tool",
+            "content": [
+                {"type": "text", "text": "(no output)"},
+                {"type": "plotly_html", "html": "<div>chart1</div>"},
+                {"type": "plotly_html", "html": "<div>chart2</div>"},
+            ],
+        }
+        htmls = get_plotly_htmls_from_tool_result(msg)
+        assert len(htmls) == 2
+        assert "chart1" in htmls[0]
+        assert "chart2" in htmls[1]
+
+    @pytest.mark.parametrize("content", ["Just a string result", [{"type": "text", "text": "No plotly here"}]])
+    def test_get_plotly_htmls_from_tool_result_returns_empty_without_plotly(self, content):
+        """get_plotly_htmls_from_tool_result should return an empty list for string content or no plotly blocks."""
+        assert get_plotly_htmls_from_tool_result({"role": "tool", "content": content}) == []
+
+    @pytest.mark.parametrize("htmls", [[], None])
+    def test_chat_plotly_returns_none_without_charts(self, htmls):
+        """ChatPlotly should return None for an empty list or None."""
+        assert ChatPlotly(htmls) is None
+
+    def test_chat_plotly_renders_iframes(self):
+        """ChatPlotly should render iframes for provided HTML."""
+        result = ChatPlotly(["<div>chart1</div>", "<div>chart2</div>"])
+        html = to_xml(result)
+        assert html.count("<iframe") == 2
+        assert "chart1" in html
+        assert "chart2" in html
+
+    def test_chat_plotly_not_in_chat_bubble(self):
+        """ChatPlotly should render full-width, not in chat bubble."""
+        result = ChatPlotly(["<div>chart</div>"])
+        html = to_xml(result)
+        # Should NOT have chat-start class (not in chat bubble)
+        assert "chat-start" not in html
+        assert "chat-end" not in html
@@ -0,0 +1,101 @@
+"""Tests for agents/ui/images.py."""
+
+import base64
+from unittest.mock import patch
+
+import pytest
+from cachetools import TTLCache
+
+import agents.ui.images as images_module
+from agents.ui.images import clear_images, get_image, image_src, refresh_images, store_images, user_images
+
+PNG_URL = "data:image/png;base64,iVBORw0KGgo="
+
+
+@pytest.fixture(autouse=True)
+def empty_store():
+    user_images.clear()
+    images_module._image_keys.clear()
+    yield
+    user_images.clear()
+    images_module._image_keys.clear()
+
+
+class TestImageSrc:
+    """Tests for swapping data URIs for /img/{key} URLs."""
+
+    def test_data_uri_is_shortened(self):
+        assert image_src(PNG_URL).startswith("/img/")
+
+    def test_rendering_stores_nothing(self):
+        image_src(PNG_URL)
+        assert len(user_images) == 0
+
+    def test_same_image_gets_same_url(self):
+        url = "data:image/jpeg;base64,/9j/4AAQ"
+        assert image_src(url) == image_src(url)
+
+    def test_different_images_get_different_urls(self):
+        assert image_src("data:image/png;base64,AAAA") != image_src("data:image/png;base64,BBBB")
+
+    @pytest.mark.parametrize(
+        "url",
+        [
+            "https://example.com/cat.png",
+            "data:image/png;base64,not base64!",
+            "data:image/svg+xml,<svg></svg>",
+        ],
+    )
+    def test_other_urls_pass_through(self, url):
+        assert image_src(url) == url
+
+
+class TestImageStore:
+    """Tests for the per-user image store."""
+
+    def test_stored_image_is_served_to_its_user(self):
+        store_images("user-1", [PNG_URL])
+        key = image_src(PNG_URL).removeprefix("/img/")
+        assert get_image("user-1", key) == ("image/png", b"\x89PNG\r\n\x1a\n")
+
+    def test_other_users_cannot_see_it(self):
+        store_images("user-1", [PNG_URL])
+        key = image_src(PNG_URL).removeprefix("/img/")
+        assert get_image("user-2", key) is None
+
+    def test_non_data_uris_are_not_stored(self):
+        store_images("user-1", ["https://example.com/cat.png", "data:image/png;base64,not base64!"])
+        assert "user-1" not in user_images
+
+    def test_unknown_key_returns_none(self):
+        store_images("user-1", [PNG_URL])
+        assert get_image("user-1", "missing") is None
+
+    def test_streamed_image_is_decoded_once(self):
+        """Storing a tool result's image and rendering it in the chat and trace decodes it once."""
+        with patch("agents.ui.images.base64.b64decode", wraps=base64.b64decode) as decode:
+            store_images("user-1", [PNG_URL])
+            image_src(PNG_URL)
+            image_src(PNG_URL)
+        assert decode.call_count == 1
+
+    def test_refresh_pushes_back_expiry(self):
+        """Images live as long as the history that shows them, not just since they were last stored."""
+        now = [0]
+        store = TTLCache(maxsize=10, ttl=60, timer=lambda: now[0])
+        with patch.object(images_module, "user_images", store):
+            store_images("user-1", [PNG_URL])
+            now[0] = 50
+            refresh_images("user-1")
+            now[0] = 100  # past the original expiry, within the refreshed one
+
+            assert get_image("user-1", image_src(PNG_URL).removeprefix("/img/")) is not None
+
+    def test_clear_drops_the_users_images(self):
+        store_images("user-1", [PNG_URL])
+        store_images("user-2", [PNG_URL])
+        clear_images("user-1")
+
+        key = image_src(PNG_URL).removeprefix("/img/")
+        assert get_image("user-1", key) is None
+        assert get_image("user-2", key) is not None
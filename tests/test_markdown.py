@@ -84,6 +84,10 @@ class TestApplyClasses:
         result = apply_classes(html, custom_map)
         assert "custom-class" in result
 
+    def test_empty_class_map_leaves_classes_alone(self):
+        result = apply_classes('<p class="existing">Hello</p>', {})
+        assert result == '<p class="existing">Hello</p>'
+
     def test_handles_invalid_html_gracefully(self):
         # Should return original string if parsing fails
         invalid = "not valid html <<<"
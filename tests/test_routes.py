@@ -1,75 +1,131 @@
 """Tests for web routes/endpoints."""
 
+import asyncio
 import importlib
-from unittest.mock import AsyncMock, MagicMock, patch
+import os
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
 
 import pytest
+from dotenv import dotenv_values
+from fasthtml.common import Div, Pre
 from starlette.testclient import TestClient
 
 import agents.tools as tools_module
+import agents.ui.components as components_module
+import agents.ui.images as images_module
+from agents.ui import image_src, store_images
 
 
-@pytest.fixture
+# Decided at collection time, so `-m slow` without a key skips instead of failing on the network
+_HAS_LLM_KEY = bool(os.getenv("ANTHROPIC_API_KEY") or dotenv_values().get("ANTHROPIC_API_KEY"))
+
+
+@pytest.fixture(scope="module")
 def mock_init_sandbox():
     """Mock init_sandbox to avoid creating real Modal sandboxes during tests."""
     return AsyncMock()
 
 
-@pytest.fixture
-def web_app(monkeypatch, mock_init_sandbox):
-    """Create a fresh app instance for testing."""
-    monkeypatch.setenv("FAST_APP_SECRET", "test-secret")
-    monkeypatch.setattr("agents.tools.init_sandbox", mock_init_sandbox)
+@pytest.fixture(scope="module")
+def web_app(mock_init_sandbox):
+    """Load the app once for this module (reloading main per test is the slow part)."""
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("FAST_APP_SECRET", "test-secret")
+        mp.setattr("agents.tools.init_sandbox", mock_init_sandbox)
 
-    import main as main_module
+        import main as main_module
 
-    importlib.reload(main_module)
-    main_module._mock_init_sandbox = mock_init_sandbox  # Expose for assertions
-    return main_module
+        importlib.reload(main_module)
+        main_module._mock_init_sandbox = mock_init_sandbox  # Expose for assertions
+        yield main_module
 
 
-@pytest.fixture
-def client(web_app):
-    """Create a test client."""
-    # Clear all user data before each test
+def _clear_app_state(web_app):
+    """Clear the per-user state the shared app keeps between tests."""
     tools_module.user_sandboxes.clear()
     tools_module.user_messages.clear()
-    return TestClient(web_app.app)
+    images_module.user_images.clear()
+    components_module.user_traces.clear()
+    web_app._mock_init_sandbox.reset_mock()
+    # Init tasks left over from another test's event loop
+    web_app._sandbox_init_tasks.clear()
 
 
-class TestIndexRoute:
-    """Tests for GET /"""
+@pytest.fixture(autouse=True)
+def reset_state(web_app):
+    """Reset the per-user state before each test."""
+    _clear_app_state(web_app)
 
-    def test_index_returns_200(self, client):
-        resp = client.get("/")
-        assert resp.status_code == 200
 
-    def test_index_has_title(self, client):
-        resp = client.get("/")
-        assert "Agent Chat" in resp.text
+@pytest.fixture(scope="class")
+def index_response(web_app):
+    """One page load shared by the TestIndexRoute tests that only inspect the response."""
+    _clear_app_state(web_app)
+    with TestClient(web_app.app) as test_client:
+        response = test_client.get("/")
+    _clear_app_state(web_app)
+    return response
+
 
-    def test_index_has_chat_container(self, client):
-        resp = client.get("/")
-        assert 'id="chat-container"' in resp.text
+@pytest.fixture(scope="class")
+def chat_response(web_app):
+    """One message post shared by the TestChatRoute tests that only inspect the response."""
+    _clear_app_state(web_app)
+    with TestClient(web_app.app) as test_client:
+        test_client.get("/")  # Clear first and establish session
+        response = test_client.post("/chat", data={"message": "Hello"})
+    _clear_app_state(web_app)
+    return response
 
-    def test_index_has_trace_container(self, client):
-        resp = client.get("/")
-        assert 'id="trace-container"' in resp.text
 
-    def test_index_has_input_form(self, client):
-        resp = client.get("/")
-        assert 'name="message"' in resp.text
+@pytest.fixture
+def session_user_id(client):
+    """Load the page once (starting a session) and return that session's user_id."""
+    client.get("/")
+    # There's only one user in each test
+    return next(iter(tools_module.user_messages))
 
-    def test_index_has_clear_button(self, client):
-        resp = client.get("/")
-        assert "Clear" in resp.text
 
-    def test_index_clears_messages_on_load(self, web_app, client):
-        # First request to establish session and get user_id
-        client.get("/")
-        # Get the user_id from the cache (there's only one user in tests)
-        user_id = list(tools_module.user_messages.keys())[0]
-        messages = tools_module.get_messages(user_id)
+def wait_for_sandbox_inits(client, web_app):
+    """Let the background sandbox inits started by the last request finish (they run on the client's loop)."""
+
+    async def drain():
+        await asyncio.gather(*web_app._sandbox_init_tasks)
+
+    client.portal.call(drain)
+
+
+@pytest.fixture
+def client(web_app):
+    """Create a test client."""
+    # As a context manager the client keeps one event loop thread for all its requests
+    # (otherwise it starts a new one per request)
+    with TestClient(web_app.app) as test_client:
+        yield test_client
+
+
+class TestIndexRoute:
+    """Tests for GET /"""
+
+    def test_index_returns_200(self, index_response):
+        assert index_response.status_code == 200
+
+    @pytest.mark.parametrize(
+        "needle",
+        [
+            "Agent Chat",  # Title
+            'id="chat-container"',
+            'id="trace-container"',
+            'name="message"',  # Input form
+            "Clear",  # Clear button
+        ],
+    )
+    def test_index_contains(self, index_response, needle):
+        assert needle in index_response.text
+
+    def test_index_clears_messages_on_load(self, client, session_user_id):
+        messages = tools_module.get_messages(session_user_id)
 
         # Add a message
         messages.append({"role": "user", "content": "test"})
@@ -77,12 +133,12 @@ class TestIndexRoute:
 
         # Loading index should clear messages
         client.get("/")
-        messages = tools_module.get_messages(user_id)
+        messages = tools_module.get_messages(session_user_id)
         assert len(messages) == 0
 
     def test_index_initializes_sandbox(self, web_app, client):
-        web_app._mock_init_sandbox.reset_mock()
         client.get("/")
+        wait_for_sandbox_inits(client, web_app)
         web_app._mock_init_sandbox.assert_called_once()
 
 
@@ -93,20 +149,17 @@ class TestClearRoute:
         resp = client.post("/clear")
         assert resp.status_code == 200
 
-    def test_clear_empties_messages(self, web_app, client):
-        # First request to establish session
-        client.get("/")
-        user_id = list(tools_module.user_messages.keys())[0]
-        messages = tools_module.get_messages(user_id)
+    def test_clear_empties_messages(self, client, session_user_id):
+        messages = tools_module.get_messages(session_user_id)
 
         messages.append({"role": "user", "content": "test"})
         client.post("/clear")
-        messages = tools_module.get_messages(user_id)
+        messages = tools_module.get_messages(session_user_id)
         assert len(messages) == 0
 
     def test_clear_initializes_sandbox(self, web_app, client):
-        web_app._mock_init_sandbox.reset_mock()
         client.post("/clear")
+        wait_for_sandbox_inits(client, web_app)
         web_app._mock_init_sandbox.assert_called_once()
 
     def test_clear_returns_empty_trace(self, client):
@@ -127,268 +180,266 @@ class TestChatRoute:
         assert resp.status_code == 200
         assert resp.text == ""
 
-    def test_valid_message_adds_to_history(self, web_app, client):
-        client.get("/")  # Clear messages first and establish session
-        user_id = list(tools_module.user_messages.keys())[0]
-
+    def test_valid_message_adds_to_history(self, client, session_user_id):
         client.post("/chat", data={"message": "Hello agent"})
-        messages = tools_module.get_messages(user_id)
+        messages = tools_module.get_messages(session_user_id)
         # Should have system prompt + user message
         assert len(messages) == 2
         assert messages[0]["role"] == "system"
         assert messages[1]["role"] == "user"
         assert messages[1]["content"] == "Hello agent"
 
-    def test_valid_message_returns_chat_bubble(self, client):
-        client.get("/")  # Clear first
-        resp = client.post("/chat", data={"message": "Hello"})
-        assert "Hello" in resp.text
-        assert "chat-bubble" in resp.text
+    @pytest.mark.parametrize(
+        "needle",
+        [
+            "Hello",  # Chat bubble
+            "chat-bubble",
+            'sse-connect="/agent-stream"',  # SSE container
+            'id="trace-container"',  # Trace update
+            'hx-swap-oob="true"',
+        ],
+    )
+    def test_valid_message_returns(self, chat_response, needle):
+        assert needle in chat_response.text
 
-    def test_valid_message_returns_sse_container(self, client):
-        client.get("/")
-        resp = client.post("/chat", data={"message": "Hello"})
-        assert 'sse-connect="/agent-stream"' in resp.text
+    def test_valid_message_returns_thinking_indicator(self, chat_response):
+        assert "thinking" in chat_response.text.lower()
 
-    def test_valid_message_returns_thinking_indicator(self, client):
-        client.get("/")
-        resp = client.post("/chat", data={"message": "Hello"})
-        assert "thinking" in resp.text.lower()
 
-    def test_valid_message_returns_trace_update(self, client):
-        client.get("/")
-        resp = client.post("/chat", data={"message": "Hello"})
-        assert 'id="trace-container"' in resp.text
-        assert 'hx-swap-oob="true"' in resp.text
+class TestCoalesce:
+    """Tests for batching agent events into SSE frames."""
 
+    @staticmethod
+    async def _collect(web_app, events, window=0.005, keepalive=None):
+        return [batch async for batch in web_app.coalesce(events, window, keepalive)]
 
-def _mock_llm_response(content="This is a mock response.", tool_calls=None):
-    """Create a mock litellm completion response."""
-    mock_message = MagicMock()
-    mock_message.content = content
-    mock_message.tool_calls = tool_calls
+    async def test_events_arriving_together_share_a_batch(self, web_app):
+        async def events():
+            yield {"type": "usage", "total": 1}
+            yield {"role": "tool", "content": "x"}
 
-    mock_choice = MagicMock()
-    mock_choice.message = mock_message
+        assert await self._collect(web_app, events()) == [[{"type": "usage", "total": 1}, {"role": "tool", "content": "x"}]]
 
-    mock_response = MagicMock()
-    mock_response.choices = [mock_choice]
-    # Mock usage with real integer for token count formatting
-    mock_response.usage.total_tokens = 100
+    async def test_events_apart_are_split(self, web_app):
+        async def events():
+            yield {"type": "usage", "total": 1}
+            await asyncio.sleep(0.05)
+            yield {"type": "usage", "total": 2}
 
-    return mock_response
+        assert len(await self._collect(web_app, events())) == 2
 
+    async def test_final_response_flushes_batch(self, web_app):
+        final = {"role": "assistant", "content": "done"}
 
-class TestAgentStreamRoute:
-    """Tests for GET /agent-stream (SSE endpoint)"""
+        async def events():
+            yield {"type": "usage", "total": 1}
+            yield final
 
-    def test_agent_stream_returns_event_stream(self, web_app, client):
-        """Test SSE endpoint with mocked LLM."""
-        # Establish session first
-        client.get("/")
-        user_id = list(tools_module.user_messages.keys())[0]
-        messages = tools_module.get_messages(user_id)
-        messages.append({"role": "user", "content": "Hello"})
+        batches = await self._collect(web_app, events(), window=10)
+        assert batches[-1][-1] is final
 
-        with patch("agents.agent.litellm.completion") as mock_completion:
-            mock_completion.return_value = _mock_llm_response("Hello! How can I help?")
+    async def test_idle_stream_yields_keepalive(self, web_app):
+        async def events():
+            await asyncio.sleep(0.05)
+            yield {"role": "assistant", "content": "done"}
 
-            resp = client.get("/agent-stream")
-            assert resp.status_code == 200
-            assert "text/event-stream" in resp.headers.get("content-type", "")
+        batches = await self._collect(web_app, events(), keepalive=0.01)
+        assert batches[0] == []
+        assert batches[-1] == [{"role": "assistant", "content": "done"}]
 
-    def test_agent_stream_includes_response_content(self, web_app, client):
-        """Test that SSE stream includes the agent's response."""
-        # Establish session first
-        client.get("/")
-        user_id = list(tools_module.user_messages.keys())[0]
-        messages = tools_module.get_messages(user_id)
-        messages.append({"role": "user", "content": "Hi"})
+    async def test_reraises_generator_errors(self, web_app):
+        async def failing():
+            yield {"type": "usage", "total": 1}
+            raise ValueError("boom")
+
+        with pytest.raises(ValueError, match="boom"):
+            await self._collect(web_app, failing())
+
+
+class TestStartSandboxInit:
+    """Tests for the bounded background sandbox init."""
+
+    async def test_concurrent_inits_are_capped(self, web_app, monkeypatch):
+        running = 0
+        peak = 0
+
+        async def slow_init(user_id):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        monkeypatch.setattr(web_app, "init_sandbox", slow_init)
+
+        for i in range(40):
+            web_app.start_sandbox_init(f"user-{i}")
+        await asyncio.gather(*web_app._sandbox_init_tasks)
+
+        assert peak == 16
+        assert not web_app._sandbox_init_tasks
+
+    async def test_each_event_loop_gets_its_own_limit(self, web_app):
+        """A semaphore binds to one loop, so a second loop (e.g. a TestClient portal) needs its own."""
 
-        with patch("agents.agent.litellm.completion") as mock_completion:
-            mock_completion.return_value = _mock_llm_response("Mocked agent response")
+        async def limit():
+            return web_app._sandbox_init_limit()
 
-            resp = client.get("/agent-stream")
-            assert "Mocked agent response" in resp.text
+        # A second loop is the point of this test, so it gets one in a worker thread
+        other_loop_limit = await asyncio.to_thread(asyncio.run, limit())
 
-    def test_agent_stream_handles_tool_calls(self, web_app, client):
+        assert await limit() is web_app._sandbox_init_limit()
+        assert other_loop_limit is not web_app._sandbox_init_limit()
+
+    async def test_cancelled_while_waiting_never_starts_init(self, web_app, monkeypatch):
+        calls = []
+
+        async def init(user_id):
+            calls.append(user_id)
+
+        monkeypatch.setattr(web_app, "init_sandbox", init)
+
+        web_app.start_sandbox_init("user-1")
+        for task in web_app._sandbox_init_tasks:
+            task.cancel()
+        await asyncio.gather(*web_app._sandbox_init_tasks, return_exceptions=True)
+
+        assert calls == []
+
+    async def test_init_errors_are_reported(self, web_app, monkeypatch, capsys):
+        async def failing_init(user_id):
+            raise RuntimeError("modal down")
+
+        monkeypatch.setattr(web_app, "init_sandbox", failing_init)
+
+        web_app.start_sandbox_init("user-1")
+        await asyncio.gather(*web_app._sandbox_init_tasks, return_exceptions=True)
+
+        assert "modal down" in capsys.readouterr().err
+
+
+class TestAgentEvent:
+    """Tests for SSE frame encoding of agent events."""
+
+    def test_frame_has_event_and_data_lines(self, web_app):
+        frame = web_app.agent_event((Div("hi", id="a"), Div("there", id="b")))
+        assert isinstance(frame, bytes)
+        assert frame.startswith(b"event: AgentEvent\ndata: ")
+        assert frame.endswith(b"\n\n")
+        assert b'<div id="a">hi</div>' in frame
+        assert b'<div id="b">there</div>' in frame
+
+    def test_multiline_content_gets_data_prefix_per_line(self, web_app):
+        frame = web_app.agent_event((Pre("line1\nline2\r\nline3"),))
+        lines = frame.decode().rstrip("\n").split("\n")
+        assert lines[0] == "event: AgentEvent"
+        assert all(line.startswith("data: ") for line in lines[1:])
+        assert len(lines) == 4
+
+
+def _mock_llm_response(content="This is a mock response.", tool_calls=None, total_tokens=100):
+    """Create a fake litellm completion response (just the attributes run_agent reads)."""
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content, tool_calls=tool_calls))],
+        usage=SimpleNamespace(total_tokens=total_tokens),
+    )
+
+
+PNG_URL = "data:image/png;base64,iVBORw0KGgo="
+
+
+class TestImageRoute:
+    """Tests for GET /img/{key}"""
+
+    def test_serves_stored_image(self, client, session_user_id):
+        store_images(session_user_id, [PNG_URL])
+        resp = client.get(image_src(PNG_URL))
+        assert resp.status_code == 200
+        assert resp.headers["content-type"] == "image/png"
+        assert resp.content == b"\x89PNG\r\n\x1a\n"
+
+    def test_other_users_image_returns_404(self, client, session_user_id):
+        store_images("someone-else", [PNG_URL])
+        resp = client.get(image_src(PNG_URL))
+        assert resp.status_code == 404
+
+    def test_streamed_tool_result_stores_its_images(self, web_app):
+        msg = {"role": "tool", "tool_call_id": "call_1", "content": [{"type": "image_url", "image_url": PNG_URL}]}
+        web_app.stream_fragments(msg, "user-1")
+        assert images_module.get_image("user-1", image_src(PNG_URL).removeprefix("/img/")) is not None
+
+    def test_image_missing_from_store_is_recovered_from_history(self, client, session_user_id):
+        tools_module.append_message(
+            session_user_id, {"role": "tool", "tool_call_id": "call_1", "content": [{"type": "image_url", "image_url": PNG_URL}]}
+        )
+        # Not stored (e.g. expired or evicted), but the history still shows it
+        resp = client.get(image_src(PNG_URL))
+        assert resp.status_code == 200
+        assert resp.content == b"\x89PNG\r\n\x1a\n"
+
+    def test_clear_drops_stored_images(self, client, session_user_id):
+        store_images(session_user_id, [PNG_URL])
+        client.post("/clear")
+        assert client.get(image_src(PNG_URL)).status_code == 404
+
+    def test_unknown_key_returns_404(self, client):
+        resp = client.get("/img/0000000000000000")
+        assert resp.status_code == 404
+
+
+class TestAgentStreamRoute:
+    """Tests for GET /agent-stream (SSE endpoint)"""
+
+    @pytest.fixture
+    def mock_completion(self, monkeypatch):
+        """Patch the LLM call; tests set return_value or side_effect."""
+        mock = AsyncMock()
+        monkeypatch.setattr("agents.agent.litellm.acompletion", mock)
+        return mock
+
+    def test_agent_stream_streams_response(self, client, session_user_id, mock_completion):
+        """Test SSE endpoint with mocked LLM: headers and the agent's response."""
+        messages = tools_module.get_messages(session_user_id)
+        messages.append({"role": "user", "content": "Hello"})
+
+        mock_completion.return_value = _mock_llm_response("Mocked agent response")
+
+        resp = client.get("/agent-stream")
+        assert resp.status_code == 200
+        assert "text/event-stream" in resp.headers.get("content-type", "")
+        assert resp.headers["x-accel-buffering"] == "no"
+        assert "no-transform" in resp.headers["cache-control"]
+        assert "Mocked agent response" in resp.text
+
+    def test_agent_stream_handles_tool_calls(self, client, session_user_id, mock_completion):
         """Test SSE with tool calls (mocked)."""
-        # Establish session first
-        client.get("/")
-        user_id = list(tools_module.user_messages.keys())[0]
-        messages = tools_module.get_messages(user_id)
+        messages = tools_module.get_messages(session_user_id)
         messages.append({"role": "user", "content": "Run some code"})
 
         # First call returns tool call, second returns final response
-        mock_tool_call = MagicMock()
-        mock_tool_call.id = "call_123"
-        mock_tool_call.function.name = "run_code"
-        mock_tool_call.function.arguments = '{"code": "print(42)"}'
-
-        with patch("agents.agent.litellm.completion") as mock_completion:
-            mock_completion.side_effect = [
-                _mock_llm_response(content=None, tool_calls=[mock_tool_call]),
-                _mock_llm_response("The result is 42!"),
-            ]
-
-            resp = client.get("/agent-stream")
-            assert resp.status_code == 200
-            assert "42" in resp.text
-
-
-class TestImageHelpers:
-    """Tests for image extraction and rendering helpers."""
-
-    def test_get_images_from_tool_result_extracts_urls(self):
-        """get_images_from_tool_result should extract image URLs from content blocks."""
-        from agents.ui import get_images_from_tool_result
-
-        msg = {
-            "role": "tool",
-            "content": [
-                {"type": "text", "text": "Plot created"},
-                {"type": "image_url", "image_url": "data:image/png;base64,ABC123"},
-                {"type": "image_url", "image_url": "data:image/png;base64,DEF456"},
-            ],
-        }
-        images = get_images_from_tool_result(msg)
-        assert len(images) == 2
-        assert "ABC123" in images[0]
-        assert "DEF456" in images[1]
-
-    def test_get_images_from_tool_result_returns_empty_for_string_content(self):
-        """get_images_from_tool_result should return empty list for string content."""
-        from agents.ui import get_images_from_tool_result
-
-        msg = {"role": "tool", "content": "Just a string result"}
-        images = get_images_from_tool_result(msg)
-        assert images == []
-
-    def test_get_images_from_tool_result_returns_empty_for_no_images(self):
-        """get_images_from_tool_result should return empty list when no images in blocks."""
-        from agents.ui import get_images_from_tool_result
-
-        msg = {
-            "role": "tool",
-            "content": [{"type": "text", "text": "No images here"}],
-        }
-        images = get_images_from_tool_result(msg)
-        assert images == []
-
-    def test_chat_images_returns_none_for_empty(self):
-        """ChatImages should return None for empty image list."""
-        from agents.ui import ChatImages
-
-        result = ChatImages([])
-        assert result is None
-
-    def test_chat_images_returns_none_for_none(self):
-        """ChatImages should return None for None input."""
-        from agents.ui import ChatImages
-
-        result = ChatImages(None)
-        assert result is None
-
-    def test_chat_images_renders_images(self):
-        """ChatImages should render img tags for provided URLs."""
-        from fasthtml.common import to_xml
-        from agents.ui import ChatImages
-
-        result = ChatImages(["data:image/png;base64,IMG1", "data:image/png;base64,IMG2"])
-        html = to_xml(result)
-        # Each image has a thumbnail and a modal image (2 images * 2 = 4 img tags)
-        assert html.count("<img") == 4
-        assert "IMG1" in html
-        assert "IMG2" in html
-        assert "chat-start" in html
-
-
-class TestPlotlyHelpers:
-    """Tests for Plotly extraction and rendering helpers."""
-
-    def test_get_plotly_htmls_from_tool_result_extracts_html(self):
-        """get_plotly_htmls_from_tool_result should extract HTML from content blocks."""
-        from agents.ui import get_plotly_htmls_from_tool_result
-
-        msg = {
-            "role": "tool",
-            "content": [
-                {"type": "text", "text": "(no output)"},
-                {"type": "plotly_html", "html": "<div>chart1</div>"},
-                {"type": "plotly_html", "html": "<div>chart2</div>"},
-            ],
-        }
-        htmls = get_plotly_htmls_from_tool_result(msg)
-        assert len(htmls) == 2
-        assert "chart1" in htmls[0]
-        assert "chart2" in htmls[1]
-
-    def test_get_plotly_htmls_from_tool_result_returns_empty_for_string_content(self):
-        """get_plotly_htmls_from_tool_result should return empty list for string content."""
-        from agents.ui import get_plotly_htmls_from_tool_result
-
-        msg = {"role": "tool", "content": "Just a string result"}
-        htmls = get_plotly_htmls_from_tool_result(msg)
-        assert htmls == []
-
-    def test_get_plotly_htmls_from_tool_result_returns_empty_for_no_plotly(self):
-        """get_plotly_htmls_from_tool_result should return empty list when no plotly in blocks."""
-        from agents.ui import get_plotly_htmls_from_tool_result
-
-        msg = {
-            "role": "tool",
-            "content": [{"type": "text", "text": "No plotly here"}],
-        }
-        htmls = get_plotly_htmls_from_tool_result(msg)
-        assert htmls == []
-
-    def test_chat_plotly_returns_none_for_empty(self):
-        """ChatPlotly should return None for empty list."""
-        from agents.ui import ChatPlotly
-
-        result = ChatPlotly([])
-        assert result is None
-
-    def test_chat_plotly_returns_none_for_none(self):
-        """ChatPlotly should return None for None input."""
-        from agents.ui import ChatPlotly
-
-        result = ChatPlotly(None)
-        assert result is None
-
-    def test_chat_plotly_renders_iframes(self):
-        """ChatPlotly should render iframes for provided HTML."""
-        from fasthtml.common import to_xml
-        from agents.ui import ChatPlotly
-
-        result = ChatPlotly(["<div>chart1</div>", "<div>chart2</div>"])
-        html = to_xml(result)
-        assert html.count("<iframe") == 2
-        assert "chart1" in html
-        assert "chart2" in html
-
-    def test_chat_plotly_not_in_chat_bubble(self):
-        """ChatPlotly should render full-width, not in chat bubble."""
-        from fasthtml.common import to_xml
-        from agents.ui import ChatPlotly
-
-        result = ChatPlotly(["<div>chart</div>"])
-        html = to_xml(result)
-        # Should NOT have chat-start class (not in chat bubble)
-        assert "chat-start" not in html
-        assert "chat-end" not in html
+        mock_tool_call = SimpleNamespace(
+            id="call_123",
+            function=SimpleNamespace(name="run_code", arguments='{"code": "print(42)"}'),
+        )
+
+        mock_completion.side_effect = [
+            _mock_llm_response(content=None, tool_calls=[mock_tool_call]),
+            _mock_llm_response("The result is 42!"),
+        ]
+
+        resp = client.get("/agent-stream")
+        assert resp.status_code == 200
+        assert "42" in resp.text
 
 
 @pytest.mark.slow
+@pytest.mark.skipif(not _HAS_LLM_KEY, reason="needs ANTHROPIC_API_KEY (env or .env)")
 class TestAgentStreamIntegration:
     """Integration tests that hit real LLM - skipped by default."""
 
-    def test_real_agent_response(self, web_app, client):
+    def test_real_agent_response(self, client, session_user_id):
         """Test the full agent flow with real LLM."""
-        # Establish session first
-        client.get("/")
-        user_id = list(tools_module.user_messages.keys())[0]
-        messages = tools_module.get_messages(user_id)
+        messages = tools_module.get_messages(session_user_id)
         messages.append({"role": "user", "content": "What is 2+2? Reply with just the number."})
 
         resp = client.get("/agent-stream")
@@ -1,13 +1,20 @@
 """Tests for agents/tools.py."""
 
-from unittest.mock import MagicMock, patch
+from unittest.mock import patch
+
+import pytest
+from cachetools import TTLCache
 
 import agents.tools as tools_module
 
 from agents.tools import (
     TOOL_FUNCTIONS,
     TOOLS,
+    append_message,
+    clear_messages,
     current_user_id,
+    ensure_system_prompt,
+    get_messages,
     get_sandbox,
     init_sandbox,
     reset_sandbox,
@@ -18,12 +25,61 @@ from agents.tools import (
 TEST_USER_ID = "test-user-123"
 
 
+class StubSandbox:
+    """Stand-in for ModalSandbox with just the methods tools.py calls."""
+
+    def __init__(self, result=None, error=None, terminate_error=None):
+        self.result = result
+        self.error = error
+        self.terminate_error = terminate_error
+        self.codes = []  # Code passed to run_code, in order
+        self.terminate_calls = 0
+
+    def run_code(self, code):
+        self.codes.append(code)
+        if self.error:
+            raise self.error
+        return self.result
+
+    def terminate(self):
+        self.terminate_calls += 1
+        if self.terminate_error:
+            raise self.terminate_error
+
+
+@pytest.fixture(autouse=True)
+def isolated_sandboxes():
+    """Run each test against an empty user_sandboxes; the previous contents come back afterwards."""
+    with patch.dict(tools_module.user_sandboxes, clear=True):
+        yield
+
+
+@pytest.fixture
+def user_context():
+    """Set current_user_id to the test user, restoring the previous value afterwards."""
+    token = current_user_id.set(TEST_USER_ID)
+    yield TEST_USER_ID
+    current_user_id.reset(token)
+
+
+@pytest.fixture
+def mock_sandbox_class():
+    """Patch ModalSandbox in agents.tools so no real sandboxes are created."""
+    with patch("agents.tools.ModalSandbox") as mock:
+        yield mock
+
+
+@pytest.fixture(scope="module")
+def tool_names():
+    """Names of the tools in the TOOLS schema list."""
+    return {t["function"]["name"] for t in TOOLS}
+
+
 class TestToolDefinitions:
     """Tests for tool definitions."""
 
-    def test_tools_list_contains_expected_tools(self):
+    def test_tools_list_contains_expected_tools(self, tool_names):
         """TOOLS list should contain run_code."""
-        tool_names = [t["function"]["name"] for t in TOOLS]
         assert "run_code" in tool_names
 
     def test_tool_functions_mapping(self):
@@ -34,30 +90,20 @@ class TestToolDefinitions:
 class TestSandboxManagement:
     """Tests for sandbox lifecycle management."""
 
-    def setup_method(self):
-        """Reset sandbox state before each test."""
-        tools_module.user_sandboxes.clear()
-
-    def teardown_method(self):
-        """Clean up sandbox state after each test."""
-        tools_module.user_sandboxes.clear()
-
-    @patch("agents.tools.ModalSandbox")
     def test_get_sandbox_creates_new_sandbox(self, mock_sandbox_class):
         """get_sandbox should create a new sandbox when none exists."""
-        mock_instance = MagicMock()
-        mock_sandbox_class.return_value = mock_instance
+        stub = StubSandbox()
+        mock_sandbox_class.return_value = stub
 
         result = get_sandbox(TEST_USER_ID)
 
         mock_sandbox_class.assert_called_once()
-        assert result is mock_instance
+        assert result is stub
 
-    @patch("agents.tools.ModalSandbox")
     def test_get_sandbox_returns_existing_sandbox(self, mock_sandbox_class):
         """get_sandbox should return existing sandbox if already created."""
-        mock_instance = MagicMock()
-        mock_sandbox_class.return_value = mock_instance
+        stub = StubSandbox()
+        mock_sandbox_class.return_value = stub
 
         first_call = get_sandbox(TEST_USER_ID)
         second_call = get_sandbox(TEST_USER_ID)
@@ -66,11 +112,10 @@ class TestSandboxManagement:
         mock_sandbox_class.assert_called_once()
         assert first_call is second_call
 
-    @patch("agents.tools.ModalSandbox")
     def test_reset_sandbox_terminates_and_clears(self, mock_sandbox_class):
         """reset_sandbox should terminate existing sandbox and clear reference."""
-        mock_instance = MagicMock()
-        mock_sandbox_class.return_value = mock_instance
+        stub = StubSandbox()
+        mock_sandbox_class.return_value = stub
 
         # Create a sandbox
         get_sandbox(TEST_USER_ID)
@@ -79,7 +124,7 @@ class TestSandboxManagement:
         # Reset it
         reset_sandbox(TEST_USER_ID)
 
-        mock_instance.terminate.assert_called_once()
+        assert stub.terminate_calls == 1
         assert TEST_USER_ID not in tools_module.user_sandboxes
 
     def test_reset_sandbox_when_none_exists(self):
@@ -88,187 +133,241 @@ class TestSandboxManagement:
         reset_sandbox(TEST_USER_ID)  # Should not raise
         assert TEST_USER_ID not in tools_module.user_sandboxes
 
-    @patch("agents.tools.ModalSandbox")
     def test_reset_sandbox_ignores_termination_errors(self, mock_sandbox_class):
         """reset_sandbox should ignore errors during termination."""
-        mock_instance = MagicMock()
-        mock_instance.terminate.side_effect = Exception("Termination failed")
-        mock_sandbox_class.return_value = mock_instance
+        stub = StubSandbox(terminate_error=Exception("Termination failed"))
+        mock_sandbox_class.return_value = stub
 
         get_sandbox(TEST_USER_ID)
         reset_sandbox(TEST_USER_ID)  # Should not raise despite termination error
 
         assert TEST_USER_ID not in tools_module.user_sandboxes
 
-    @patch("agents.tools.ModalSandbox")
-    def test_get_sandbox_uses_context_var_when_user_id_none(self, mock_sandbox_class):
+    def test_get_sandbox_uses_context_var_when_user_id_none(self, mock_sandbox_class, user_context):
         """get_sandbox should use current_user_id context var when user_id is None."""
-        mock_instance = MagicMock()
-        mock_sandbox_class.return_value = mock_instance
-
-        # Set context variable
-        current_user_id.set(TEST_USER_ID)
+        stub = StubSandbox()
+        mock_sandbox_class.return_value = stub
 
         result = get_sandbox()  # No user_id passed
 
         mock_sandbox_class.assert_called_once()
-        assert result is mock_instance
+        assert result is stub
         assert TEST_USER_ID in tools_module.user_sandboxes
 
-    @patch("agents.tools.ModalSandbox")
-    def test_init_sandbox_creates_new_sandbox(self, mock_sandbox_class):
+    async def test_init_sandbox_creates_new_sandbox(self, mock_sandbox_class):
         """init_sandbox should create a new sandbox for a user."""
-        import asyncio
+        stub = StubSandbox()
+        mock_sandbox_class.return_value = stub
 
-        mock_instance = MagicMock()
-        mock_sandbox_class.return_value = mock_instance
-
-        asyncio.run(init_sandbox(TEST_USER_ID))
+        await init_sandbox(TEST_USER_ID)
 
         mock_sandbox_class.assert_called_once()
         assert TEST_USER_ID in tools_module.user_sandboxes
 
-    @patch("agents.tools.ModalSandbox")
-    def test_init_sandbox_terminates_existing_sandbox(self, mock_sandbox_class):
+    async def test_init_sandbox_terminates_existing_sandbox(self, mock_sandbox_class):
         """init_sandbox should terminate existing sandbox before creating new one."""
-        import asyncio
-
-        old_instance = MagicMock()
-        new_instance = MagicMock()
+        old_instance = StubSandbox()
+        new_instance = StubSandbox()
         mock_sandbox_class.side_effect = [old_instance, new_instance]
 
         # Create an existing sandbox first
         get_sandbox(TEST_USER_ID)
 
         # Now init should terminate old and create new
-        asyncio.run(init_sandbox(TEST_USER_ID))
+        await init_sandbox(TEST_USER_ID)
 
-        old_instance.terminate.assert_called_once()
+        assert old_instance.terminate_calls == 1
         assert tools_module.user_sandboxes[TEST_USER_ID] is new_instance
 
-    @patch("agents.tools.ModalSandbox")
-    def test_init_sandbox_ignores_termination_errors(self, mock_sandbox_class):
+    async def test_init_sandbox_ignores_termination_errors(self, mock_sandbox_class):
         """init_sandbox should ignore errors during termination of existing sandbox."""
-        import asyncio
-
-        old_instance = MagicMock()
-        old_instance.terminate.side_effect = Exception("Termination failed")
-        new_instance = MagicMock()
+        old_instance = StubSandbox(terminate_error=Exception("Termination failed"))
+        new_instance = StubSandbox()
         mock_sandbox_class.side_effect = [old_instance, new_instance]
 
         # Create an existing sandbox first
         get_sandbox(TEST_USER_ID)
 
         # Should not raise despite termination error
-        asyncio.run(init_sandbox(TEST_USER_ID))
+        await init_sandbox(TEST_USER_ID)
 
         assert tools_module.user_sandboxes[TEST_USER_ID] is new_instance
 
 
+class TestMessageStore:
+    """Tests for the per-user message store."""
+
+    def test_get_messages_creates_and_reuses_list(self):
+        """get_messages should return the same list for the same user."""
+        with patch.object(tools_module, "user_messages", TTLCache(maxsize=10, ttl=60)):
+            messages = get_messages(TEST_USER_ID)
+            messages.append({"role": "user", "content": "Hi"})
+
+            assert get_messages(TEST_USER_ID) is messages
+
+    def test_get_messages_refreshes_ttl(self):
+        """Accessing a conversation should push back its expiry."""
+        now = [0]
+        store = TTLCache(maxsize=10, ttl=60, timer=lambda: now[0])
+        with patch.object(tools_module, "user_messages", store):
+            messages = get_messages(TEST_USER_ID)
+            now[0] = 50
+            get_messages(TEST_USER_ID)
+            now[0] = 100  # past the original expiry, within the refreshed one
+
+            assert get_messages(TEST_USER_ID) is messages
+
+    def test_idle_messages_expire(self):
+        """A conversation not accessed within the TTL should be dropped."""
+        now = [0]
+        store = TTLCache(maxsize=10, ttl=60, timer=lambda: now[0])
+        with patch.object(tools_module, "user_messages", store):
+            messages = get_messages(TEST_USER_ID)
+            now[0] = 61
+
+            assert get_messages(TEST_USER_ID) is not messages
+
+    def test_clear_messages_leaves_empty_history(self):
+        """Clearing replaces the user's history with a fresh empty list."""
+        with patch.object(tools_module, "user_messages", TTLCache(maxsize=10, ttl=60)):
+            old = get_messages(TEST_USER_ID)
+            old.append({"role": "user", "content": "Hi"})
+            clear_messages(TEST_USER_ID)
+
+            assert get_messages(TEST_USER_ID) == []
+            assert get_messages(TEST_USER_ID) is not old
+
+    def test_ensure_system_prompt_inserts_once(self):
+        """The system prompt should be added at the front, and only once."""
+        with patch.object(tools_module, "user_messages", TTLCache(maxsize=10, ttl=60)):
+            append_message(TEST_USER_ID, {"role": "user", "content": "Hi"})
+            ensure_system_prompt(TEST_USER_ID, "Be helpful")
+            ensure_system_prompt(TEST_USER_ID, "Be helpful")
+
+            messages = get_messages(TEST_USER_ID)
+            assert [m["role"] for m in messages] == ["system", "user"]
+            assert messages[0]["content"] == "Be helpful"
+
+    def test_append_message_mutates_stored_list(self):
+        """append_message should add to the same list get_messages returns."""
+        with patch.object(tools_module, "user_messages", TTLCache(maxsize=10, ttl=60)):
+            messages = get_messages(TEST_USER_ID)
+            append_message(TEST_USER_ID, {"role": "user", "content": "Hi"})
+
+            assert messages == [{"role": "user", "content": "Hi"}]
+
+    def test_history_trimmed_to_whole_turns(self):
+        """Old turns are dropped whole once the cap is passed; the system prompt stays."""
+        with (
+            patch.object(tools_module, "user_messages", TTLCache(maxsize=10, ttl=60)),
+            patch.object(tools_module, "MAX_HISTORY_MESSAGES", 6),
+        ):
+            ensure_system_prompt(TEST_USER_ID, "Be helpful")
+            for turn in range(3):
+                append_message(TEST_USER_ID, {"role": "user", "content": f"q{turn}"})
+                append_message(TEST_USER_ID, {"role": "assistant", "tool_calls": [{"id": f"c{turn}"}]})
+                append_message(TEST_USER_ID, {"role": "tool", "tool_call_id": f"c{turn}", "content": "ok"})
+
+            messages = get_messages(TEST_USER_ID)
+            assert messages[0] == {"role": "system", "content": "Be helpful"}
+            assert [m["role"] for m in messages[1:]] == ["user", "assistant", "tool", "user", "assistant", "tool"]
+            assert messages[1]["content"] == "q1"
+
+    def test_single_oversized_turn_is_kept(self):
+        """A turn bigger than the cap can't be split, so it stays."""
+        with (
+            patch.object(tools_module, "user_messages", TTLCache(maxsize=10, ttl=60)),
+            patch.object(tools_module, "MAX_HISTORY_MESSAGES", 2),
+        ):
+            append_message(TEST_USER_ID, {"role": "user", "content": "q"})
+            messages = get_messages(TEST_USER_ID)
+            messages.extend({"role": "tool", "content": "ok"} for _ in range(5))
+            tools_module._trim_history(messages)
+
+            assert len(messages) == 6
+
+
+@pytest.mark.usefixtures("user_context")
 class TestRunCode:
     """Tests for run_code function."""
 
-    def setup_method(self):
-        """Reset sandbox state and set user context before each test."""
-        tools_module.user_sandboxes.clear()
-        current_user_id.set(TEST_USER_ID)
-
-    def teardown_method(self):
-        """Clean up sandbox state after each test."""
-        tools_module.user_sandboxes.clear()
-
-    @patch("agents.tools.ModalSandbox")
     def test_run_code_returns_content_blocks(self, mock_sandbox_class):
         """run_code should return content blocks with text."""
-        mock_instance = MagicMock()
-        mock_instance.run_code.return_value = {"stdout": "Hello\n", "stderr": "", "images": []}
-        mock_sandbox_class.return_value = mock_instance
+        stub = StubSandbox(result={"stdout": "Hello\n", "stderr": "", "images": []})
+        mock_sandbox_class.return_value = stub
 
         result = run_code('print("Hello")')
 
-        assert isinstance(result, list)
-        assert result[0] == {"type": "text", "text": "stdout:\nHello\n"}
-        mock_instance.run_code.assert_called_once_with('print("Hello")')
+        assert result == [{"type": "text", "text": "stdout:\nHello\n"}]
+        assert stub.codes == ['print("Hello")']
 
-    @patch("agents.tools.ModalSandbox")
     def test_run_code_handles_sandbox_exception(self, mock_sandbox_class):
         """run_code should return error content blocks when sandbox raises exception."""
         mock_sandbox_class.side_effect = Exception("Sandbox creation failed")
 
         result = run_code("print('test')")
 
-        assert isinstance(result, list)
-        assert result[0]["type"] == "text"
-        assert "Sandbox creation failed" in result[0]["text"]
+        assert result == [{"type": "text", "text": "stderr:\nSandbox creation failed"}]
 
-    @patch("agents.tools.ModalSandbox")
     def test_run_code_handles_execution_exception(self, mock_sandbox_class):
         """run_code should return error content blocks when code execution raises exception."""
-        mock_instance = MagicMock()
-        mock_instance.run_code.side_effect = Exception("Execution error")
-        mock_sandbox_class.return_value = mock_instance
+        stub = StubSandbox(error=Exception("Execution error"))
+        mock_sandbox_class.return_value = stub
 
         result = run_code("invalid code")
 
-        assert isinstance(result, list)
-        assert result[0]["type"] == "text"
-        assert "Execution error" in result[0]["text"]
-
-    @patch("agents.tools.ModalSandbox")
-    def test_run_code_returns_images(self, mock_sandbox_class):
-        """run_code should include image content blocks when images are present."""
-        mock_instance = MagicMock()
-        mock_instance.run_code.return_value = {
-            "stdout": "Plot created\n",
-            "stderr": "",
-            "images": ["iVBORbase64img1", "iVBORbase64img2"],  # PNG magic bytes prefix
-        }
-        mock_sandbox_class.return_value = mock_instance
-
-        result = run_code("import matplotlib.pyplot as plt; plt.plot([1,2,3])")
-
-        assert isinstance(result, list)
-        assert len(result) == 3  # 1 text + 2 images
-        assert result[0] == {"type": "text", "text": "stdout:\nPlot created\n"}
-        assert result[1] == {"type": "image_url", "image_url": "data:image/png;base64,iVBORbase64img1"}
-        assert result[2] == {"type": "image_url", "image_url": "data:image/png;base64,iVBORbase64img2"}
-
-    @patch("agents.tools.ModalSandbox")
-    def test_run_code_returns_plotly_htmls(self, mock_sandbox_class):
-        """run_code should include plotly_html content blocks when plotly figures are present."""
-        mock_instance = MagicMock()
-        mock_instance.run_code.return_value = {
-            "stdout": "",
-            "stderr": "",
-            "images": [],
-            "plotly_htmls": ["<div>chart1</div>", "<div>chart2</div>"],
-        }
-        mock_sandbox_class.return_value = mock_instance
-
-        result = run_code("import plotly.express as px; fig = px.scatter(x=[1,2], y=[3,4])")
-
-        assert isinstance(result, list)
-        assert len(result) == 3  # 1 text + 2 plotly
-        assert result[0] == {"type": "text", "text": "(no output)"}
-        assert result[1] == {"type": "plotly_html", "html": "<div>chart1</div>"}
-        assert result[2] == {"type": "plotly_html", "html": "<div>chart2</div>"}
-
-    @patch("agents.tools.ModalSandbox")
-    def test_run_code_returns_mixed_images_and_plotly(self, mock_sandbox_class):
-        """run_code should include both images and plotly when both are present."""
-        mock_instance = MagicMock()
-        mock_instance.run_code.return_value = {
-            "stdout": "Mixed output\n",
-            "stderr": "",
-            "images": ["/9j/base64img"],  # JPEG magic bytes prefix
-            "plotly_htmls": ["<div>plotly</div>"],
-        }
-        mock_sandbox_class.return_value = mock_instance
-
-        result = run_code("# create both")
-
-        assert isinstance(result, list)
-        assert len(result) == 3  # 1 text + 1 image + 1 plotly
-        assert result[0] == {"type": "text", "text": "stdout:\nMixed output\n"}
-        assert result[1] == {"type": "image_url", "image_url": "data:image/jpeg;base64,/9j/base64img"}
-        assert result[2] == {"type": "plotly_html", "html": "<div>plotly</div>"}
+        assert result == [{"type": "text", "text": "stderr:\nExecution error"}]
+
+    @pytest.mark.parametrize(
+        "sandbox_result, expected",
+        [
+            pytest.param(
+                {
+                    "stdout": "Plot created\n",
+                    "stderr": "",
+                    "images": ["iVBORbase64img1", "iVBORbase64img2"],  # PNG magic bytes prefix
+                },
+                [
+                    {"type": "text", "text": "stdout:\nPlot created\n"},
+                    {"type": "image_url", "image_url": "data:image/png;base64,iVBORbase64img1"},
+                    {"type": "image_url", "image_url": "data:image/png;base64,iVBORbase64img2"},
+                ],
+                id="images",
+            ),
+            pytest.param(
+                {
+                    "stdout": "",
+                    "stderr": "",
+                    "images": [],
+                    "plotly_htmls": ["<div>chart1</div>", "<div>chart2</div>"],
+                },
+                [
+                    {"type": "text", "text": "(no output)"},
+                    {"type": "plotly_html", "html": "<div>chart1</div>"},
+                    {"type": "plotly_html", "html": "<div>chart2</div>"},
+                ],
+                id="plotly",
+            ),
+            pytest.param(
+                {
+                    "stdout": "Mixed output\n",
+                    "stderr": "",
+                    "images": ["/9j/base64img"],  # JPEG magic bytes prefix
+                    "plotly_htmls": ["<div>plotly</div>"],
+                },
+                [
+                    {"type": "text", "text": "stdout:\nMixed output\n"},
+                    {"type": "image_url", "image_url": "data:image/jpeg;base64,/9j/base64img"},
+                    {"type": "plotly_html", "html": "<div>plotly</div>"},
+                ],
+                id="mixed",
+            ),
+        ],
+    )
+    def test_run_code_returns_visuals(self, mock_sandbox_class, sandbox_result, expected):
+        """run_code should add image and plotly_html content blocks after the text block."""
+        mock_sandbox_class.return_value = StubSandbox(result=sandbox_result)
+
+        result = run_code("# create visuals")
+
+        assert result == expected